@@ -0,0 +1,352 @@
+import base64
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+
+from celery.app.task import Task
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from django.core.cache import cache
+from django.utils.timezone import now
+from pretix_googlepaypasses import callbacks, comms
+from pretix_googlepaypasses.debounce import _key as debounce_key
+from pretix_googlepaypasses.models import OutboxEntry
+
+ISSUER_ID = '3388000000000000000'
+TOKEN_PATH = '/token'
+API_PATH = '/walletobjects/v1'
+BATCH_PATH = '/batch'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeWalletApi:
+    # Local stand-in for the Google Pay API for Passes: keeps classes and objects in memory, answers the OAuth token
+    # requests of google-auth and the batch endpoint, and can be told to be slow, to fail or to throttle.
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.items = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api._handle(self, 'GET')
+
+            def do_PUT(self):
+                api._handle(self, 'PUT')
+
+            def do_POST(self):
+                api._handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.counts[key] += value
+
+    def api_calls(self):
+        # HTTP requests against the API, not counting the OAuth token requests
+        with self.lock:
+            return self.counts['requests']
+
+    def credentials(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        return json.dumps({
+            'type': 'service_account',
+            'project_id': 'benchmark',
+            'private_key_id': uuid.uuid4().hex,
+            'private_key': key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            ).decode('utf-8'),
+            'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+            'client_id': '1',
+            'token_uri': self.url + TOKEN_PATH,
+        })
+
+    def _injected_status(self):
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def _handle(self, handler, method: str):
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        url = urlparse(handler.path)
+
+        if url.path == TOKEN_PATH:
+            self.count('token')
+            return self._respond(handler, 200, {'access_token': uuid.uuid4().hex, 'token_type': 'Bearer',
+                                                'expires_in': 3600})
+
+        self.count('requests')
+        if self.latency:
+            time.sleep(self.random.uniform(self.latency / 2, self.latency * 1.5))
+
+        status = self._injected_status()
+        if status:
+            self.count(str(status))
+            return self._respond(handler, status, {'error': {'code': status}})
+
+        if url.path == BATCH_PATH and method == 'POST':
+            return self._batch(handler, body)
+        elif url.path.startswith(API_PATH + '/'):
+            status, payload = self._call(method, url.path[len(API_PATH) + 1:], parse_qs(url.query), body)
+            return self._respond(handler, status, payload)
+
+        return self._respond(handler, 404, {'error': {'code': 404}})
+
+    def _call(self, method: str, path: str, query: dict, body: bytes):
+        parts = path.split('/', 1)
+        resource = self.items.setdefault(parts[0], OrderedDict())
+
+        if len(parts) == 1 and method == 'GET':
+            self.count('list')
+            return 200, self._list(resource, query)
+
+        item_id = unquote(parts[1]) if len(parts) > 1 else None
+        if method == 'GET':
+            self.count('get')
+            return (200, resource[item_id]) if item_id in resource else (404, {'error': {'code': 404}})
+        elif method == 'PUT':
+            self.count('put')
+            item = json.loads(body.decode('utf-8') or '{}')
+            with self.lock:
+                resource[item_id] = item
+            return 200, item
+
+        return 405, {'error': {'code': 405}}
+
+    def _list(self, resource: OrderedDict, query: dict):
+        if 'classId' in query:
+            items = [i for i in resource.values() if i.get('classId') == query['classId'][0]]
+        elif 'issuerId' in query:
+            items = [i for i in resource.values() if str(i.get('id', '')).startswith(query['issuerId'][0] + '.')]
+        else:
+            items = list(resource.values())
+
+        offset = int(query.get('token', ['0'])[0])
+        limit = int(query.get('maxResults', ['100'])[0])
+        result = {'resources': items[offset:offset + limit], 'pagination': {}}
+        if offset + limit < len(items):
+            result['pagination']['nextPageToken'] = str(offset + limit)
+        return result
+
+    def _batch(self, handler, body: bytes):
+        self.count('batch')
+        boundary = re.search(r'boundary=([^;]+)', handler.headers.get('Content-Type', '')).group(1)
+        parts = []
+
+        for part in body.decode('utf-8').split('--%s' % boundary):
+            content_id = re.search(r'Content-ID: <item(\d+)>', part)
+            request_line = re.search(r'^(GET|PUT|POST) (\S+) HTTP/1\.1', part, re.MULTILINE)
+            if not content_id or not request_line:
+                continue
+
+            item_body = part.split('\r\n\r\n', 2)[-1].strip().encode('utf-8')
+            self.count('batch_items')
+            status = self._injected_status()
+            if status:
+                self.count(str(status))
+                payload = {'error': {'code': status}}
+            else:
+                status, payload = self._call(request_line.group(1), request_line.group(2)[len(API_PATH) + 1:], {},
+                                             item_body)
+
+            parts.append(
+                '--batch_response\r\n'
+                'Content-Type: application/http\r\n'
+                'Content-ID: <response-item%s>\r\n'
+                '\r\n'
+                'HTTP/1.1 %d Status\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n'
+                '\r\n'
+                '%s\r\n' % (content_id.group(1), status, json.dumps(payload))
+            )
+        parts.append('--batch_response--\r\n')
+
+        self._respond(handler, 200, ''.join(parts).encode('utf-8'), 'multipart/mixed; boundary=batch_response')
+
+    def _respond(self, handler, status: int, payload, content_type='application/json; charset=UTF-8'):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+@contextmanager
+def use_fake_api(api: FakeWalletApi):
+    # Points the API clients at the stand-in - the clients are evicted on both ends, so no client keeps talking to
+    # the other side.
+    previous = (comms.API_URL, comms.BATCH_URL, os.environ.get('NO_PROXY'))
+    comms.API_URL = api.url + API_PATH
+    comms.BATCH_URL = api.url + BATCH_PATH
+    os.environ['NO_PROXY'] = '127.0.0.1'
+    comms.evict_comms()
+
+    try:
+        yield api
+    finally:
+        comms.API_URL, comms.BATCH_URL = previous[:2]
+        if previous[2] is None:
+            os.environ.pop('NO_PROXY', None)
+        else:
+            os.environ['NO_PROXY'] = previous[2]
+        comms.evict_comms()
+
+
+def _public_key(key):
+    return base64.b64encode(key.public_key().public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )).decode('utf-8')
+
+
+def _sign(key, data: bytes):
+    return base64.b64encode(key.sign(data, ec.ECDSA(hashes.SHA256()))).decode('utf-8')
+
+
+class FakeCallbackSigner:
+    # Signs callbacks the way Google does (ECv2SigningOnly), with a root key of its own that is put in place of
+    # Google's root signing keys while installed.
+
+    def __init__(self, issuer_id: str = ISSUER_ID, lifetime: int = 3600):
+        self.issuer_id = issuer_id
+        self.lifetime = lifetime
+        self.root_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.intermediate_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+        signed_key = json.dumps({
+            'keyValue': _public_key(self.intermediate_key),
+            'keyExpiration': str(int((time.time() + lifetime) * 1000)),
+        })
+        self.intermediate_signing_key = {
+            'signedKey': signed_key,
+            'signatures': [_sign(self.root_key, callbacks._length_prefixed(
+                callbacks.SENDER_ID, callbacks.PROTOCOL_VERSION, signed_key
+            ))],
+        }
+
+    def install(self):
+        keys = [{'keyValue': _public_key(self.root_key), 'protocolVersion': callbacks.PROTOCOL_VERSION}]
+        cache.set(callbacks.ROOT_KEYS_CACHE_KEY, (keys, time.time() + self.lifetime), self.lifetime)
+        callbacks._root_keys.update({'keys': None, 'expires': 0})
+
+    def uninstall(self):
+        cache.delete(callbacks.ROOT_KEYS_CACHE_KEY)
+        callbacks._root_keys.update({'keys': None, 'expires': 0})
+
+    def sign(self, class_id: str, object_id: str, event_type: str):
+        signed_message = json.dumps({
+            'classId': class_id,
+            'objectId': object_id,
+            'eventType': event_type,
+            'expTimeMillis': int((time.time() + self.lifetime) * 1000),
+            'count': 1,
+            'nonce': uuid.uuid4().hex,
+        })
+        return {
+            'protocolVersion': callbacks.PROTOCOL_VERSION,
+            'intermediateSigningKey': self.intermediate_signing_key,
+            'signedMessage': signed_message,
+            'signature': _sign(self.intermediate_key, callbacks._length_prefixed(
+                callbacks.SENDER_ID, self.issuer_id, callbacks.PROTOCOL_VERSION, signed_message
+            )),
+        }
+
+
+class TaskRecorder:
+    # Collects the plugin's tasks instead of handing them to the broker, so that the fan-out of a change can be
+    # counted. drain() then runs the collected tasks one after the other in this process.
+
+    def __init__(self):
+        self.queue = deque()
+        self.counts = Counter()
+        self._apply_async = None
+
+    def __enter__(self):
+        recorder = self
+        self._apply_async = Task.apply_async
+
+        def apply_async(task, args=None, kwargs=None, **options):
+            if not task.name.startswith('pretix_googlepaypasses.'):
+                return recorder._apply_async(task, args, kwargs, **options)
+            recorder.counts[task.name.rsplit('.', 1)[-1]] += 1
+            recorder.queue.append((task, tuple(args or ()), kwargs or {}))
+
+        Task.apply_async = apply_async
+        return self
+
+    def __exit__(self, *exc):
+        Task.apply_async = self._apply_async
+        return False
+
+    def reset(self):
+        self.queue.clear()
+        self.counts.clear()
+
+    def drain(self):
+        from pretix_googlepaypasses.tasks import DEBOUNCED_TASKS
+
+        executed = 0
+        while self.queue:
+            task, args, kwargs = self.queue.popleft()
+            if task.name.endswith('.run_debounced'):
+                # Waiting out the debounce window would only measure the window
+                cache.delete(debounce_key(*args) + '_pending')
+                task, args = DEBOUNCED_TASKS[args[0]], args[1:]
+            elif task.name.endswith('.drain_outbox'):
+                # Same for the delay of debounced outbox entries - failed ones keep their backoff
+                OutboxEntry.objects.filter(state=OutboxEntry.STATE_PENDING, attempts=0).update(next_attempt=now())
+                if not OutboxEntry.objects.filter(state=OutboxEntry.STATE_PENDING, next_attempt__lte=now()).exists():
+                    # A wake-up for backed off entries, running it right away would only reschedule it again
+                    continue
+            task.apply(args=args, kwargs=kwargs)
+            executed += 1
+        return executed
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
@@ -0,0 +1,266 @@
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from urllib.parse import urlparse
+
+# Runs against the throwaway database and cache of benchmarks/settings.py, never against an installation's own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+import django  # NoQA
+
+django.setup()
+
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer
+from pretix.base.services.orders import OrderError
+from benchmarks.fakes import (
+    ISSUER_ID, FakeCallbackSigner, FakeWalletApi, TaskRecorder, percentile,
+    use_fake_api,
+)
+from pretix_googlepaypasses.googlepaypasses import WalletobjectOutput
+from pretix_googlepaypasses.helpers import get_passes
+from pretix_googlepaypasses.models import GooglePayPass, OutboxEntry
+from pretix_googlepaypasses.ratelimit import get_requests_per_second
+
+GOOGLE_USER_AGENT = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+
+
+class Command(BaseCommand):
+    help = ("Benchmark ticket downloads, webhooks and the task fan-out of order changes against a local stand-in for "
+            "the Google Pay API for Passes. Uses a temporary database that is thrown away afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=100)
+        parser.add_argument('--positions', type=int, default=20, help='Positions per order')
+        parser.add_argument('--downloads', type=int, default=200, help='Number of positions to download')
+        parser.add_argument('--webhooks', type=int, default=500)
+        parser.add_argument('--changes', type=int, default=10, help='Number of orders to change')
+        parser.add_argument('--latency', type=float, default=0.05, help='Mean API latency in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of API calls answered with HTTP 503')
+        parser.add_argument('--throttle-rate', type=float, default=0.0,
+                            help='Share of API calls answered with HTTP 429')
+        parser.add_argument('--fat-jwt', action='store_true', help='Hand out fat JWTs')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', action='store_true', help='Print the results as one JSON document')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        self.options = options
+        api = FakeWalletApi(latency=options['latency'], error_rate=options['error_rate'],
+                            throttle_rate=options['throttle_rate'], seed=options['seed']).start()
+        signer = FakeCallbackSigner()
+        results = {'requests_per_second': get_requests_per_second()}
+
+        try:
+            with use_fake_api(api), TaskRecorder() as recorder:
+                signer.install()
+                self.stderr.write('Creating %d orders with %d positions each' % (options['orders'],
+                                                                                 options['positions']))
+                self.event = self.create_event(api.credentials())
+
+                ops = list(OrderPosition.objects.filter(order__event=self.event).select_related(
+                    'order', 'order__event', 'item', 'variation', 'addon_to', 'seat'
+                ).order_by('order_id', 'positionid')[:options['downloads']])
+
+                results['downloads'] = self.bench_downloads(api, recorder, ops)
+                results['webhooks'] = self.bench_webhooks(api, recorder, signer, ops)
+                results['changes'] = self.bench_changes(api, recorder)
+                results['api'] = dict(api.counts)
+        finally:
+            signer.uninstall()
+            api.stop()
+
+        if options['json']:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.print_results(results)
+
+    def create_event(self, credentials):
+        organizer = Organizer.objects.create(name='Google Pay Passes benchmark', slug='gpp-benchmark-%d' % time.time())
+        organizer.settings.googlepaypasses_issuer_id = ISSUER_ID
+        organizer.settings.googlepaypasses_credentials = credentials
+
+        event = Event.objects.create(
+            organizer=organizer, name='Benchmark', slug='benchmark', currency='EUR',
+            date_from=now() + timedelta(days=30), plugins='pretix_googlepaypasses', live=True,
+        )
+        event.settings.ticketoutput_googlepaypasses__enabled = True
+        event.settings.ticketoutput_googlepaypasses_fat_jwt = self.options['fat_jwt']
+        item = Item.objects.create(event=event, name='Ticket', default_price=Decimal('23.00'), admission=True)
+
+        for i in range(self.options['orders']):
+            with transaction.atomic():
+                order = Order.objects.create(
+                    event=event, status=Order.STATUS_PAID, email='benchmark@example.org', locale='en',
+                    datetime=now(), expires=now() + timedelta(days=10),
+                    total=Decimal('23.00') * self.options['positions'],
+                )
+                for positionid in range(1, self.options['positions'] + 1):
+                    OrderPosition.objects.create(
+                        order=order, item=item, price=Decimal('23.00'), positionid=positionid,
+                        attendee_name_parts={'full_name': 'Attendee %d-%d' % (i, positionid)},
+                    )
+
+        return event
+
+    def bench_downloads(self, api, recorder, ops):
+        results = {}
+
+        for run in ('cold', 'warm'):
+            self.stderr.write('Downloading %d passes (%s)' % (len(ops), run))
+            recorder.reset()
+            latencies = []
+            calls_before = api.api_calls()
+            failed = 0
+            unavailable = 0
+
+            for op in ops:
+                start = time.perf_counter()
+                try:
+                    if not WalletobjectOutput(op.order.event).generate(op):
+                        failed += 1
+                except OrderError:
+                    # The circuit breaker is open
+                    unavailable += 1
+                latencies.append(time.perf_counter() - start)
+
+            calls = api.api_calls() - calls_before
+            results[run] = {
+                'downloads': len(ops),
+                'failed': failed,
+                'unavailable': unavailable,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'api_calls_per_download': calls / len(ops) if ops else 0.0,
+                'tasks': dict(recorder.counts),
+            }
+            # Fat JWTs are only uploaded in the background
+            recorder.drain()
+
+        return results
+
+    def bench_webhooks(self, api, recorder, signer, ops):
+        passes = list(get_passes(ops).values())
+        if not passes:
+            return {}
+
+        # Every tenth callback reports a deleted pass, which makes us shred the object
+        callbacks = [
+            signer.sign(p.class_id, p.object_id, 'del' if i % 10 == 9 else 'save')
+            for i, p in zip(range(self.options['webhooks']), passes * (self.options['webhooks'] // len(passes) + 1))
+        ]
+        bodies = [json.dumps(c) for c in callbacks]
+
+        client = Client(HTTP_HOST=urlparse(django_settings.SITE_URL).netloc)
+        url = reverse('plugins:pretix_googlepaypasses:webhook', kwargs={'organizer': self.event.organizer.slug})
+        self.stderr.write('Sending %d callbacks' % len(bodies))
+
+        recorder.reset()
+        statuses = Counter()
+        start = time.perf_counter()
+        for body in bodies:
+            response = client.post(url, data=body, content_type='application/json', HTTP_USER_AGENT=GOOGLE_USER_AGENT)
+            statuses[response.status_code] += 1
+        received = time.perf_counter() - start
+
+        tasks = dict(recorder.counts)
+        calls_before = api.api_calls()
+        start = time.perf_counter()
+        processed = recorder.drain()
+        processing = time.perf_counter() - start
+
+        return {
+            'callbacks': len(bodies),
+            'statuses': {str(k): v for k, v in statuses.items()},
+            'received_per_second': len(bodies) / received if received else 0.0,
+            'processed_per_second': processed / processing if processing else 0.0,
+            'tasks': tasks,
+            'api_calls': api.api_calls() - calls_before,
+        }
+
+    def bench_changes(self, api, recorder):
+        orders = list(Order.objects.filter(
+            id__in=GooglePayPass.objects.filter(event=self.event).values('position__order_id')
+        ).order_by('id')[:self.options['changes']])
+        results = {}
+
+        for change in ('event.settings', 'order.changed.item', 'order.secret.changed'):
+            self.stderr.write('Logging %s for %d orders' % (change, len(orders)))
+            recorder.reset()
+            log_entries = 0
+
+            if change == 'event.settings':
+                self.event.log_action('pretix.event.settings', data={})
+                log_entries += 1
+            for order in orders:
+                if change == 'order.changed.item':
+                    for op in order.positions.all():
+                        order.log_action('pretix.event.order.changed.item', data={
+                            'position': op.id, 'positionid': op.positionid, 'old_item': op.item_id,
+                            'new_item': op.item_id,
+                        })
+                        log_entries += 1
+                elif change == 'order.secret.changed':
+                    order.log_action('pretix.event.order.secret.changed', data={})
+                    log_entries += 1
+
+            tasks = dict(recorder.counts)
+            outbox_entries = OutboxEntry.objects.filter(event=self.event).count()
+            calls_before = api.api_calls()
+            start = time.perf_counter()
+            executed = recorder.drain()
+
+            results[change] = {
+                'log_entries': log_entries,
+                'outbox_entries': outbox_entries,
+                'orders': len(orders) if change != 'event.settings' else 0,
+                'tasks': tasks,
+                'tasks_per_order': sum(tasks.values()) / len(orders) if orders and change != 'event.settings' else None,
+                'tasks_executed': executed,
+                'api_calls': api.api_calls() - calls_before,
+                'seconds': time.perf_counter() - start,
+            }
+
+        return results
+
+    def print_results(self, results):
+        print('Rate limit: %d requests per second' % results['requests_per_second'])
+
+        for run, stats in results['downloads'].items():
+            print('Downloads (%s): %d, %d failed, %d unavailable - p50 %.1f ms, p99 %.1f ms, %.2f API calls per '
+                  'download, tasks: %r' % (run, stats['downloads'], stats['failed'], stats['unavailable'],
+                                           stats['p50_ms'], stats['p99_ms'], stats['api_calls_per_download'],
+                                           stats['tasks']))
+
+        webhooks = results['webhooks']
+        if webhooks:
+            print('Webhooks: %d - %.1f/s received, %.1f tasks/s processed, statuses: %r, tasks: %r, %d API calls' % (
+                webhooks['callbacks'], webhooks['received_per_second'], webhooks['processed_per_second'],
+                webhooks['statuses'], webhooks['tasks'], webhooks['api_calls']
+            ))
+
+        for change, stats in results['changes'].items():
+            print('%s: %d log entries, %d outbox entries, tasks: %r (%s per order), %d API calls in %.2fs' % (
+                change, stats['log_entries'], stats['outbox_entries'], stats['tasks'],
+                '%.1f' % stats['tasks_per_order'] if stats['tasks_per_order'] is not None else '-',
+                stats['api_calls'], stats['seconds']
+            ))
+
+        print('API: %r' % results['api'])
+
+
+if __name__ == '__main__':
+    call_command('migrate', verbosity=0)
+    Command().run_from_argv([sys.argv[0], 'benchmark'] + sys.argv[1:])
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+from pretix.settings import *  # NoQA
+
+# The benchmark installs its own root signing keys in the cache and creates an organizer with thousands of orders,
+# so it gets a database of its own and a cache that lives in its process only. Tasks of pretix itself run in place
+# instead of going to a broker that might be shared with a running installation.
+BENCHMARK_DIR = tempfile.mkdtemp(prefix='googlepaypasses-benchmark-')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DIR, 'db.sqlite3'),
+    }
+}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+MEDIA_ROOT = os.path.join(BENCHMARK_DIR, 'media')
+HAS_REDIS = False
+HAS_CELERY = False
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_ALWAYS_EAGER = True
+METRICS_ENABLED = False
@@ -0,0 +1,124 @@
+import logging
+import time
+
+from django.core.cache import cache
+from pretix_googlepaypasses.config import get_config
+from pretix_googlepaypasses.metrics import (
+    record_breaker_rejection, record_breaker_state,
+)
+from pretix_googlepaypasses.ratelimit import (
+    LANE_BACKGROUND, RetryableError, get_lane,
+)
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = 0
+STATE_OPEN = 1
+STATE_HALF_OPEN = 2
+
+FAILURE_WINDOW = 30
+# A tripped breaker is forgotten after this long without any call, so an issuer nobody uses anymore starts closed
+TRIPPED_TIMEOUT = 3600
+PROBE_TIMEOUT = 120
+
+
+class CircuitOpenError(RetryableError):
+    pass
+
+
+def get_failure_threshold():
+    # breaker_failures in the [googlepaypasses] section of pretix.cfg - failed calls within 30 seconds that trip it
+    return get_config('breaker_failures', 5)
+
+
+def get_open_duration():
+    # breaker_open_seconds in the [googlepaypasses] section of pretix.cfg - how long all calls are failed fast
+    return get_config('breaker_open_seconds', 30)
+
+
+def _key(issuer: str, name: str):
+    return 'googlepaypasses_breaker_%s_%s' % (issuer, name)
+
+
+def _state(opened):
+    if opened is None:
+        return STATE_CLOSED
+    elif time.time() < opened + get_open_duration():
+        return STATE_OPEN
+    return STATE_HALF_OPEN
+
+
+def get_retry_in(issuer: str):
+    # Seconds until the breaker lets a probe through
+    opened = cache.get(_key(issuer, 'opened'))
+    return max(0, int(opened + get_open_duration() - time.time()) + 1) if opened is not None else 0
+
+
+def claim_probe(issuer: str):
+    # Only one probe task per issuer is scheduled at a time - the task releases the claim once it is done
+    return cache.add(_key(issuer, 'probe_scheduled'), True, get_retry_in(issuer) + PROBE_TIMEOUT)
+
+
+def release_probe(issuer: str):
+    cache.delete(_key(issuer, 'probe_scheduled'))
+
+
+def before_call(issuer: str):
+    # Returns the state the breaker was in, which has to be handed to after_call. While the breaker is open every
+    # call fails right away. Once it has been open long enough, a single call from the background lane is let through
+    # as a probe - downloads keep failing fast until the probe has succeeded, so no customer waits on a timeout.
+    values = cache.get_many([_key(issuer, 'opened'), _key(issuer, 'failures')])
+    state = _state(values.get(_key(issuer, 'opened')))
+    lane = get_lane()
+
+    if state == STATE_HALF_OPEN and lane == LANE_BACKGROUND and cache.add(_key(issuer, 'probe'), True, PROBE_TIMEOUT):
+        record_breaker_state(issuer, STATE_HALF_OPEN)
+    elif state != STATE_CLOSED:
+        record_breaker_rejection(issuer, lane)
+        raise CircuitOpenError('The Google Pay API for Passes is unavailable for issuer %s' % issuer)
+
+    return state, bool(values.get(_key(issuer, 'failures')))
+
+
+def after_call(issuer: str, before, success: bool):
+    state, had_failures = before
+
+    if success:
+        if state == STATE_HALF_OPEN:
+            cache.delete_many([_key(issuer, 'opened'), _key(issuer, 'failures'), _key(issuer, 'probe')])
+            record_breaker_state(issuer, STATE_CLOSED)
+            logger.info('Google Pay API for Passes is available again for issuer %s, closing the circuit breaker', issuer)
+        elif had_failures:
+            cache.delete(_key(issuer, 'failures'))
+        return
+
+    if state == STATE_HALF_OPEN:
+        _open(issuer, reopen=True)
+        cache.delete(_key(issuer, 'probe'))
+        return
+
+    key = _key(issuer, 'failures')
+    if cache.add(key, 1, FAILURE_WINDOW):
+        failures = 1
+    else:
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            failures = 1
+            cache.set(key, failures, FAILURE_WINDOW)
+
+    if failures >= get_failure_threshold():
+        _open(issuer)
+
+
+def _open(issuer: str, reopen=False):
+    if reopen:
+        cache.set(_key(issuer, 'opened'), time.time(), TRIPPED_TIMEOUT)
+    elif not cache.add(_key(issuer, 'opened'), time.time(), TRIPPED_TIMEOUT):
+        # Another process has tripped it already
+        return
+
+    cache.delete(_key(issuer, 'failures'))
+    record_breaker_state(issuer, STATE_OPEN)
+    logger.warning('Google Pay API for Passes keeps failing for issuer %s, opening the circuit breaker for %d seconds',
+                   issuer, get_open_duration())
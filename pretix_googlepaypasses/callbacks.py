@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import json
+import logging
+import re
+import struct
+import threading
+import time
+
+import requests
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import load_der_public_key
+from django.core.cache import cache
+from pretix.base.models import Organizer
+
+logger = logging.getLogger(__name__)
+
+ROOT_KEYS_URL = 'https://pay.google.com/gp/m/issuer/keys'
+ROOT_KEYS_CACHE_KEY = 'googlepaypasses_root_signing_keys'
+ROOT_KEYS_DEFAULT_MAX_AGE = 3600
+SENDER_ID = 'GooglePayPasses'
+PROTOCOL_VERSION = 'ECv2SigningOnly'
+ISSUER_ID_CACHE_TIMEOUT = 300
+DEDUPE_TIMEOUT = 3600
+
+_root_keys = {
+    'keys': None,
+    'expires': 0,
+}
+_root_keys_lock = threading.Lock()
+
+
+class CallbackVerificationError(Exception):
+    pass
+
+
+def get_root_signing_keys():
+    # Google's root signing keys are kept in the process and in the shared cache until the max-age announced by Google
+    # runs out, so verifying a callback usually does not need any network I/O.
+    now = time.time()
+    if _root_keys['keys'] is not None and _root_keys['expires'] > now:
+        return _root_keys['keys']
+
+    with _root_keys_lock:
+        if _root_keys['keys'] is not None and _root_keys['expires'] > now:
+            return _root_keys['keys']
+
+        cached = cache.get(ROOT_KEYS_CACHE_KEY)
+        if cached and cached[1] > now:
+            keys, expires = cached
+        else:
+            response = requests.get(ROOT_KEYS_URL, timeout=10)
+            response.raise_for_status()
+
+            match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+            max_age = int(match.group(1)) if match else ROOT_KEYS_DEFAULT_MAX_AGE
+
+            keys = [k for k in response.json().get('keys', []) if k.get('protocolVersion') == PROTOCOL_VERSION]
+            expires = now + max_age
+            cache.set(ROOT_KEYS_CACHE_KEY, (keys, expires), max_age)
+
+        _root_keys['keys'] = keys
+        _root_keys['expires'] = expires
+
+    return keys
+
+
+def get_organizer_issuer_id(organizer_slug: str):
+    cache_key = 'googlepaypasses_issuer_id_%s' % hashlib.md5(organizer_slug.encode('utf-8')).hexdigest()
+    issuer_id = cache.get(cache_key)
+
+    if issuer_id is None:
+        organizer = Organizer.objects.filter(slug=organizer_slug).first()
+        # Unknown organizers are cached as well, so that junk requests do not keep hitting the database
+        issuer_id = (organizer.settings.googlepaypasses_issuer_id or '') if organizer else ''
+        cache.set(cache_key, issuer_id, ISSUER_ID_CACHE_TIMEOUT)
+
+    return issuer_id or None
+
+
+def is_duplicate(message: dict, signed_message: str):
+    dedupe_id = message.get('nonce') or hashlib.sha256(signed_message.encode('utf-8')).hexdigest()
+    return not cache.add('googlepaypasses_callback_%s' % hashlib.md5(dedupe_id.encode('utf-8')).hexdigest(), True,
+                         DEDUPE_TIMEOUT)
+
+
+def _length_prefixed(*parts):
+    data = b''
+    for part in parts:
+        part = part.encode('utf-8')
+        data += struct.pack('<I', len(part)) + part
+    return data
+
+
+def _verify(public_key: str, signature: str, data: bytes):
+    try:
+        key = load_der_public_key(base64.b64decode(public_key), backend=default_backend())
+        key.verify(base64.b64decode(signature), data, ec.ECDSA(hashes.SHA256()))
+        return True
+    except (InvalidSignature, ValueError, TypeError):
+        return False
+
+
+def verify_callback(callback: dict, issuer_id: str):
+    now_ms = time.time() * 1000
+
+    if callback.get('protocolVersion') != PROTOCOL_VERSION:
+        raise CallbackVerificationError('Unsupported protocol version')
+
+    try:
+        signed_key = callback['intermediateSigningKey']['signedKey']
+        key_signatures = callback['intermediateSigningKey']['signatures']
+        signed_message = callback['signedMessage']
+        signature = callback['signature']
+    except (KeyError, TypeError):
+        raise CallbackVerificationError('Malformed callback')
+
+    root_keys = [
+        k['keyValue'] for k in get_root_signing_keys()
+        if 'keyExpiration' not in k or int(k['keyExpiration']) > now_ms
+    ]
+    signed_key_data = _length_prefixed(SENDER_ID, PROTOCOL_VERSION, signed_key)
+    if not any(_verify(key, sig, signed_key_data) for key in root_keys for sig in key_signatures):
+        raise CallbackVerificationError('Intermediate signing key could not be verified')
+
+    try:
+        intermediate_key = json.loads(signed_key)
+    except ValueError:
+        raise CallbackVerificationError('Malformed intermediate signing key')
+
+    if int(intermediate_key.get('keyExpiration', 0)) <= now_ms:
+        raise CallbackVerificationError('Intermediate signing key has expired')
+
+    if not _verify(intermediate_key.get('keyValue', ''), signature,
+                   _length_prefixed(SENDER_ID, issuer_id, PROTOCOL_VERSION, signed_message)):
+        raise CallbackVerificationError('Message signature could not be verified')
+
+    try:
+        message = json.loads(signed_message)
+    except ValueError:
+        raise CallbackVerificationError('Malformed message')
+
+    if int(message.get('expTimeMillis', 0)) <= now_ms:
+        raise CallbackVerificationError('Message has expired')
+
+    return message, signed_message
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+import requests
+from google.auth import jwt as google_jwt
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2 import service_account
+from pretix_googlepaypasses import breaker
+from pretix_googlepaypasses.config import get_config
+from pretix_googlepaypasses.metrics import (
+    googlepaypasses_jwt_signing_seconds, record_api_call, record_api_statuses,
+    record_cache_lookup, timed,
+)
+from pretix_googlepaypasses.ratelimit import (
+    LANE_BACKGROUND, RetryableError, acquire, get_lane,
+)
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/wallet_object.issuer']
+API_URL = 'https://walletobjects.googleapis.com/walletobjects/v1'
+BATCH_URL = 'https://walletobjects.googleapis.com/batch'
+BATCH_SIZE = 50
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# Throttling is the rate limiter's business - only these count as failures for the circuit breaker
+BREAKER_STATUS = (500, 502, 503, 504)
+CONNECT_TIMEOUT = 3.05
+# A download should rather fail than keep a worker busy for long, background work can afford to wait
+INTERACTIVE_TIMEOUT = 5
+BACKGROUND_TIMEOUT = 30
+
+_clients = {}
+_lock = threading.Lock()
+_service_accounts = {}
+_service_accounts_lock = threading.Lock()
+
+
+class ApiError(Exception):
+    pass
+
+
+def get_credentials_fingerprint(credentials: str):
+    return hashlib.sha256((credentials or '').strip().encode('utf-8')).hexdigest()
+
+
+def get_service_account(credentials: str):
+    # Parsing the JSON and loading the PEM private key into a signer is the expensive part of setting up a client, and
+    # is all that validating the settings form does, so both share the parsed credentials. Raises ValueError if the
+    # credentials are not valid.
+    fingerprint = get_credentials_fingerprint(credentials)
+
+    account = _service_accounts.get(fingerprint)
+    if account is None:
+        with _service_accounts_lock:
+            account = _service_accounts.get(fingerprint)
+            if account is None:
+                info = json.loads(credentials.strip())
+                account = (info, service_account.Credentials.from_service_account_info(info, scopes=SCOPES))
+                _service_accounts[fingerprint] = account
+
+    return account
+
+
+def is_success(status: int):
+    return 200 <= status < 300
+
+
+def get_timeout():
+    # interactive_timeout and background_timeout in the [googlepaypasses] section of pretix.cfg, in seconds
+    if get_lane() == LANE_BACKGROUND:
+        option, timeout = 'background_timeout', BACKGROUND_TIMEOUT
+    else:
+        option, timeout = 'interactive_timeout', INTERACTIVE_TIMEOUT
+
+    timeout = get_config(option, float(timeout))
+    return min(CONNECT_TIMEOUT, timeout), timeout
+
+
+class WalletClient:
+    # Drop-in replacement for walletobjects' Comms that performs the REST calls itself, so that every call goes
+    # through the shared rate limiter and retryable failures can be told apart from permanent ones. JWTs are signed
+    # with the signer of the shared parsed credentials, so the private key is only loaded once.
+
+    def __init__(self, credentials: str):
+        info, account = get_service_account(credentials)
+        self.client_email = info['client_email']
+        self.key_id = info.get('private_key_id', '')
+        self.signer = account.signer
+        self.session = AuthorizedSession(account)
+        # One service account belongs to exactly one issuer account, so it is used to key the issuer's quota.
+        self.bucket = hashlib.md5(self.client_email.encode('utf-8')).hexdigest()
+
+    def sign_jwt(self, jwt):
+        with timed(googlepaypasses_jwt_signing_seconds, 'jwt_signing', account=self.client_email):
+            return google_jwt.encode(self.signer, jwt).decode('utf-8')
+
+    def get_item(self, item_type, item_id: str):
+        response = self._request('GET', '%s/%s' % (_resource(item_type), quote(item_id, safe='')), 'get',
+                                 _issuer(item_id))
+
+        if response is None:
+            return None
+        elif response.status_code == 404:
+            return False
+        elif is_success(response.status_code):
+            return response.json()
+
+        return None
+
+    def put_item(self, item_type, item_id: str, item):
+        response = self._request('PUT', '%s/%s' % (_resource(item_type), quote(item_id, safe='')), 'put',
+                                 _issuer(item_id), json=item)
+
+        if response is not None and is_success(response.status_code):
+            return response.json()
+
+        return False
+
+    def list_items(self, item_type, issuer_id: str = None, class_id: str = None, token: str = None,
+                   max_results: int = None):
+        params = {}
+        if issuer_id:
+            params['issuerId'] = issuer_id
+        if class_id:
+            params['classId'] = class_id
+        if token:
+            params['token'] = token
+        if max_results:
+            params['maxResults'] = max_results
+
+        response = self._request('GET', _resource(item_type), 'list', _issuer(issuer_id or class_id or ''),
+                                 params=params)
+
+        if response is not None and is_success(response.status_code):
+            return response.json()
+
+        return None
+
+    def iter_items(self, item_type, issuer_id: str = None, class_id: str = None, page_size: int = 100):
+        # Follows the pagination tokens lazily, so only one page is held in memory at any time.
+        token = None
+
+        while True:
+            result = self.list_items(item_type, issuer_id=issuer_id, class_id=class_id, token=token,
+                                     max_results=page_size)
+
+            if result is None:
+                # A listing that silently ended early would look like missing objects to the callers
+                raise ApiError('Could not list %s (issuer %s, class %s)' % (_resource(item_type), issuer_id, class_id))
+
+            for resource in result.get('resources', []):
+                yield resource
+
+            token = result.get('pagination', {}).get('nextPageToken')
+            if not token:
+                return
+
+    def batch_put_items(self, resource: str, items: list):
+        # Sends PUTs for a list of (id, item) tuples through the batch endpoint and returns a dict mapping each id to
+        # the HTTP status Google answered with (0 if the whole batch request failed).
+        statuses = {}
+
+        for i in range(0, len(items), BATCH_SIZE):
+            chunk = items[i:i + BATCH_SIZE]
+            acquire(self.bucket, len(chunk))
+            chunk_statuses = self._send_batch(resource, _issuer(chunk[0][0]), [
+                ('PUT', '/walletobjects/v1/%s/%s' % (resource, quote(item_id, safe='')), item)
+                for item_id, item in chunk
+            ])
+
+            for index, (item_id, item) in enumerate(chunk):
+                statuses[item_id] = chunk_statuses.get(index, 0)
+
+            record_api_statuses(resource, 'batch_put', [statuses[item_id] for item_id, item in chunk],
+                                _issuer(chunk[0][0]))
+
+        return statuses
+
+    def _request(self, method: str, path: str, operation: str, issuer: str, **kwargs):
+        # Waiting for the rate limit comes first, as it can raise - a probe claimed by before_call would be left
+        # hanging until it times out. before_call raises CircuitOpenError if the API has been failing for this issuer.
+        acquire(self.bucket)
+        state = breaker.before_call(issuer)
+        endpoint = path.split('/', 1)[0]
+        start = time.perf_counter()
+
+        try:
+            response = self.session.request(method, '%s/%s' % (API_URL, path), timeout=get_timeout(), **kwargs)
+        except requests.RequestException as e:
+            breaker.after_call(issuer, state, False)
+            record_api_call(endpoint, operation, 'error', issuer, time.perf_counter() - start)
+            logger.warning('Request to the Google Pay API for Passes failed: %s %s - %s', method, path, e)
+            if get_lane() == LANE_BACKGROUND:
+                raise RetryableError(str(e))
+            return None
+
+        breaker.after_call(issuer, state, response.status_code not in BREAKER_STATUS)
+        record_api_call(endpoint, operation, response.status_code, issuer, time.perf_counter() - start)
+
+        if response.status_code in RETRYABLE_STATUS:
+            logger.warning('Google Pay API for Passes returned HTTP %s for %s %s', response.status_code, method, path)
+            if get_lane() == LANE_BACKGROUND:
+                raise RetryableError('HTTP %s' % response.status_code)
+        elif not is_success(response.status_code) and response.status_code != 404:
+            logger.error('Google Pay API for Passes returned HTTP %s for %s %s: %s',
+                         response.status_code, method, path, response.text)
+
+        return response
+
+    def _send_batch(self, resource: str, issuer: str, calls: list):
+        boundary = 'batch_%s' % uuid.uuid4().hex
+        body = []
+
+        for index, (method, path, item) in enumerate(calls):
+            body.append(
+                '--%s\r\n'
+                'Content-Type: application/http\r\n'
+                'Content-ID: <item%d>\r\n'
+                '\r\n'
+                '%s %s HTTP/1.1\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n'
+                '\r\n'
+                '%s\r\n' % (boundary, index, method, path, json.dumps(item) if item is not None else '')
+            )
+        body.append('--%s--\r\n' % boundary)
+        state = breaker.before_call(issuer)
+        start = time.perf_counter()
+
+        try:
+            response = self.session.post(
+                BATCH_URL,
+                data=''.join(body).encode('utf-8'),
+                headers={'Content-Type': 'multipart/mixed; boundary=%s' % boundary},
+                timeout=get_timeout(),
+            )
+        except requests.RequestException:
+            breaker.after_call(issuer, state, False)
+            record_api_call(resource, 'batch', 'error', issuer, time.perf_counter() - start)
+            logger.exception('Batch request to the Google Pay API for Passes failed.')
+            return {}
+
+        breaker.after_call(issuer, state, response.status_code not in BREAKER_STATUS)
+        record_api_call(resource, 'batch', response.status_code, issuer, time.perf_counter() - start)
+
+        if response.status_code != 200:
+            logger.error('Batch request to the Google Pay API for Passes failed with HTTP %s: %s',
+                         response.status_code, response.text)
+            return {index: response.status_code for index in range(len(calls))}
+
+        return _parse_batch_response(response)
+
+
+def _resource(item_type):
+    # The walletobjects constants are enum members named after the API resource
+    return getattr(item_type, 'name', item_type)
+
+
+def _issuer(item_id: str):
+    # Class and object ids are prefixed with the issuer id
+    return item_id.split('.', 1)[0] if '.' in item_id else item_id
+
+
+def _parse_batch_response(response):
+    match = re.search(r'boundary="?([^";]+)"?', response.headers.get('Content-Type', ''))
+    if not match:
+        return {}
+
+    statuses = {}
+    for part in response.text.split('--%s' % match.group(1)):
+        content_id = re.search(r'Content-ID:\s*<response-item(\d+)>', part, re.IGNORECASE)
+        status = re.search(r'^HTTP/[\d.]+\s+(\d{3})', part, re.MULTILINE)
+        if content_id and status:
+            statuses[int(content_id.group(1))] = int(status.group(1))
+
+    return statuses
+
+
+def get_comms(credentials: str) -> WalletClient:
+    # The client keeps an authorized HTTP session around, so handing out one long-lived instance per set of
+    # credentials and worker process allows us to reuse both the keep-alive connection pool and the OAuth access
+    # token, which is only refreshed by google-auth once it is about to expire.
+    fingerprint = get_credentials_fingerprint(credentials)
+
+    # The reuse rate ends up in googlepaypasses_cache_lookups_total{cache="client"}
+    client = _clients.get(fingerprint)
+    if client is not None:
+        record_cache_lookup('client', True)
+        return client
+
+    with _lock:
+        client = _clients.get(fingerprint)
+        record_cache_lookup('client', client is not None)
+        if client is None:
+            client = WalletClient(credentials)
+            _clients[fingerprint] = client
+            logger.debug('Created Google Pay Passes API client for credentials %s', fingerprint[:12])
+
+    return client
+
+
+def evict_comms(credentials: str = None):
+    with _lock, _service_accounts_lock:
+        if credentials is None:
+            _clients.clear()
+            _service_accounts.clear()
+        else:
+            _clients.pop(get_credentials_fingerprint(credentials), None)
+            _service_accounts.pop(get_credentials_fingerprint(credentials), None)
@@ -0,0 +1,19 @@
+from django.conf import settings as django_settings
+
+# All options live in the [googlepaypasses] section of pretix.cfg, see the README for the list
+SECTION = 'googlepaypasses'
+
+
+def get_config(option: str, default):
+    # The option is parsed as the type of its default
+    config = getattr(django_settings, 'CONFIG_FILE', None)
+    if config is None or not config.has_option(SECTION, option):
+        return default
+
+    if isinstance(default, bool):
+        return config.getboolean(SECTION, option)
+    elif isinstance(default, int):
+        return config.getint(SECTION, option)
+    elif isinstance(default, float):
+        return config.getfloat(SECTION, option)
+    return config.get(SECTION, option)
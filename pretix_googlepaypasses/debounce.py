@@ -0,0 +1,40 @@
+import time
+
+from django.core.cache import cache
+from pretix_googlepaypasses.metrics import record_debounce
+
+DEFAULT_WINDOW = 5
+
+
+def _key(name: str, target_id):
+    return 'googlepaypasses_debounce_%s_%s' % (name, target_id)
+
+
+def debounce(name: str, target_id, window: int = DEFAULT_WINDOW):
+    # Trailing-edge debounce: every trigger pushes the due time back, but only the first trigger of a burst schedules
+    # a task. That task keeps postponing itself until no trigger has arrived for a whole window.
+    from pretix_googlepaypasses.tasks import run_debounced
+
+    key = _key(name, target_id)
+    # The pending marker outlives the window generously, so a lost task does not block the target forever.
+    timeout = window * 10 + 60
+
+    cache.set(key + '_due', time.time() + window, timeout)
+    record_debounce(name, 'triggered')
+
+    if cache.add(key + '_pending', True, timeout):
+        run_debounced.apply_async(args=(name, target_id), countdown=window)
+    else:
+        record_debounce(name, 'coalesced')
+
+
+def claim(name: str, target_id):
+    key = _key(name, target_id)
+    remaining = (cache.get(key + '_due') or 0) - time.time()
+
+    if remaining > 0:
+        return remaining
+
+    cache.delete(key + '_pending')
+    record_debounce(name, 'executed')
+    return 0
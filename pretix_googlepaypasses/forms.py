@@ -1,24 +1,19 @@
-import json
 import logging
-import tempfile
+from io import BytesIO
 
 from django import forms
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
 from django.utils.translation import ugettext_lazy as _
-from google.oauth2 import service_account
 from pretix.control.forms import ClearableBasenameFileInput
+from pretix_googlepaypasses.comms import get_service_account
 
 logger = logging.getLogger(__name__)
 
 
 def validate_json_credentials(value: str):
-    value = value.strip()
     try:
-        service_account.Credentials.from_service_account_info(
-            json.loads(value),
-            scopes=['https://www.googleapis.com/auth/wallet_object.issuer'],
-        )
+        get_service_account(value)
     except ValueError:
         raise ValidationError(
             _('It seems like the credentials-file is not correct. '
@@ -29,6 +24,12 @@ def validate_json_credentials(value: str):
 class PNGImageField(forms.FileField):
     widget = ClearableBasenameFileInput
 
+    def __init__(self, *args, max_size=None, **kwargs):
+        # Google scales the images down for display anyway, so everything larger than the recommended size is just
+        # egress for us and every device that saves the pass.
+        self.max_size = max_size
+        super().__init__(*args, **kwargs)
+
     def clean(self, value, *args, **kwargs):
         value = super().clean(value, *args, **kwargs)
         if isinstance(value, UploadedFile):
@@ -40,10 +41,15 @@ class PNGImageField(forms.FileField):
             value.open('rb')
             value.seek(0)
             try:
-                with Image.open(value) as im, tempfile.NamedTemporaryFile('rb', suffix='.png') as tmpfile:
-                    im.save(tmpfile.name)
-                    tmpfile.seek(0)
-                    return SimpleUploadedFile('picture.png', tmpfile.read(), 'image png')
+                with Image.open(value) as im:
+                    if im.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                        im = im.convert('RGBA')
+                    if self.max_size:
+                        im.thumbnail(self.max_size, Image.LANCZOS)
+
+                    output = BytesIO()
+                    im.save(output, format='PNG', optimize=True)
+                    return SimpleUploadedFile('picture.png', output.getvalue(), 'image/png')
             except IOError:
                 logger.exception('Could not convert image to PNG.')
                 raise ValidationError(
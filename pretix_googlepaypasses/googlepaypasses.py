@@ -1,36 +1,55 @@
-import json
 from collections import OrderedDict
 from typing import Tuple
-from urllib.parse import urljoin
 
 from django import forms
 from django.conf import settings as django_settings
 from django.templatetags.static import static
 from django.utils.translation import ugettext_lazy as _  # NoQA
 from i18nfield.forms import I18nFormField, I18nTextarea
-from pretix.base.models import Event, OrderPosition
-from pretix.base.settings import GlobalSettingsObject
+from pretix.base.models import Event, Order, OrderPosition
+from pretix.base.services.orders import OrderError
 from pretix.base.ticketoutput import BaseTicketOutput
 from pretix.multidomain.urlreverse import build_absolute_uri
+from pretix_googlepaypasses.breaker import CircuitOpenError, claim_probe
+from pretix_googlepaypasses.comms import get_comms, is_success
 from pretix_googlepaypasses.forms import PNGImageField
 from pretix_googlepaypasses.helpers import (
-    get_class_id, get_object_id, get_translated_dict, get_translated_string,
+    claim_upload, get_cached_save_url, get_class_cache_key, get_class_id,
+    get_image_url, get_install_id, get_object_id, get_pass, get_passes,
+    get_payload_hash, get_save_url_fingerprint, get_static_labels,
+    get_translated_dict, is_class_cached, record_error, record_pass,
+    set_cached_save_url, set_class_cached,
 )
+from pretix_googlepaypasses.metrics import (
+    googlepaypasses_generation_seconds, record_cache_lookup, timed,
+)
+from pretix_googlepaypasses.models import GooglePayPass
 from walletobjects import ButtonJWT, EventTicketClass, EventTicketObject
-from walletobjects.comms import Comms
 from walletobjects.constants import (
     Barcode, ClassType, ConfirmationCode, DoorsOpen,
     MultipleDevicesAndHoldersAllowedStatus, ObjectState, ObjectType,
     ReviewStatus, Seat,
 )
 
+# The sizes recommended by Google's brand guidelines - larger uploads are scaled down
+LOGO_SIZE = (1200, 1200)
+HERO_SIZE = (1032, 336)
+SAVE_URL = 'https://pay.google.com/gp/v/save/%s'
+# Browsers and Google start truncating save links somewhere above 2000 characters
+MAX_JWT_LENGTH = 1800
+
+
+def _too_long(jwts: list):
+    # A single fat pass can exceed the limit on its own, splitting does not help then
+    return any(len(jwt) > MAX_JWT_LENGTH for jwt in jwts)
+
 
 class WalletobjectOutput(BaseTicketOutput):
     identifier = 'googlepaypasses'
     verbose_name = 'Google Pay Passes'
     download_button_icon = 'fa-google'
     download_button_text = _('Pay | Save to phone')
-    multi_download_enabled = False
+    multi_download_enabled = True
     preview_allowed = False
     javascript_required = True
 
@@ -50,6 +69,27 @@ class WalletobjectOutput(BaseTicketOutput):
                                  "legal counsel."),
                      required=True,
                  )),
+                ('fat_jwt',
+                 forms.BooleanField(
+                     label=_("Generate passes without contacting Google during the download"),
+                     help_text=_("If enabled, the complete pass is embedded into the signed link handed out to the "
+                                 "customer and no request to Google is made while they wait. The pass is then "
+                                 "uploaded to Google in the background. Since the link contains the whole pass, it "
+                                 "is considerably longer."),
+                     required=False,
+                 )),
+                ('preprovision',
+                 forms.BooleanField(
+                     label=_("Create passes in the background as soon as an order is paid"),
+                     help_text=_("By default, a pass is only transmitted to Google when the customer clicks the "
+                                 "corresponding button for the first time. If enabled, the passes of all tickets of an "
+                                 "order are created right after payment, so that the download itself is faster. "
+                                 "Please note that this transmits the data of customers that never download their "
+                                 "pass as well, and that the data is transmitted before the customer has seen the "
+                                 "privacy notice - the privacy notice for pre-provisioned passes below is shown "
+                                 "instead of the regular one."),
+                     required=False,
+                 )),
                 ('show_disclaimer',
                  forms.BooleanField(
                      label=_("Display a privacy notice to the customers before transmitting data"),
@@ -69,6 +109,20 @@ class WalletobjectOutput(BaseTicketOutput):
                      },
                      help_text=_("This text will be displayed as a privacy notice if enabled above.")
                  )),
+                ('preprovision_disclaimer_text',
+                 I18nFormField(
+                     label=_("Privacy notice for pre-provisioned passes"),
+                     required=False,
+                     widget=I18nTextarea,
+                     widget_kwargs={
+                         'attrs': {
+                             'data-display-dependency': '#id_ticketoutput_googlepaypasses_preprovision'
+                         }
+                     },
+                     help_text=_("This text will be displayed instead of the privacy notice above if passes are "
+                                 "created in the background. It must not claim that data is only transmitted once "
+                                 "the customer clicks the button.")
+                 )),
                 ('logo',
                  PNGImageField(
                      label=_("Event logo"),
@@ -96,6 +150,7 @@ class WalletobjectOutput(BaseTicketOutput):
                            )
                      ),
                      required=False,
+                     max_size=LOGO_SIZE,
                  )),
                 ('hero',
                  PNGImageField(
@@ -124,6 +179,7 @@ class WalletobjectOutput(BaseTicketOutput):
                            )
                      ),
                      required=False,
+                     max_size=HERO_SIZE,
                  )),
                 ('latitude',
                  forms.FloatField(
@@ -141,14 +197,41 @@ class WalletobjectOutput(BaseTicketOutput):
         )
 
     def generate(self, order_position: OrderPosition) -> Tuple[str, str, str]:
+        fat_jwt = self.event.settings.get('ticketoutput_googlepaypasses_fat_jwt', as_type=bool)
+
+        with timed(googlepaypasses_generation_seconds, 'generation', kind='fat_download' if fat_jwt else 'download'):
+            try:
+                if fat_jwt:
+                    return self._generate_fat(order_position)
+                return self._generate_skinny(order_position)
+            except CircuitOpenError:
+                self._unavailable()
+
+    def _unavailable(self):
+        # Rather than waiting on timeouts while Google is having trouble, the customer is told to come back - the
+        # breaker is probed in the background in the meantime.
+        from pretix_googlepaypasses.tasks import probe_api
+
+        issuer = self.event.settings.get('googlepaypasses_issuer_id')
+        if claim_probe(issuer):
+            probe_api.apply_async(args=(self.event.pk,))
+
+        raise OrderError(_('Google Pay Passes are currently unavailable. Please try again in a few minutes.'))
+
+    def _generate_skinny(self, order_position: OrderPosition):
         if not self._get_class(order_position.order.event):
             return False
 
-        ticket_object = self._get_object(order_position)
+        ticket_object, payload_hash = self._get_object_with_hash(order_position)
 
         if not ticket_object:
             return False
 
+        fingerprint = get_save_url_fingerprint(payload_hash, self._comms().key_id, django_settings.SITE_URL)
+        save_url = get_cached_save_url(ticket_object['id'], fingerprint)
+        if save_url:
+            return 'googlepaypass', 'text/uri-list', save_url
+
         generated_jwt = self._comms().sign_jwt(
             ButtonJWT(
                 origins=[django_settings.SITE_URL],
@@ -159,32 +242,230 @@ class WalletobjectOutput(BaseTicketOutput):
         )
 
         if generated_jwt:
-            return 'googlepaypass', 'text/uri-list', 'https://pay.google.com/gp/v/save/%s' % generated_jwt
+            set_cached_save_url(ticket_object['id'], fingerprint, SAVE_URL % generated_jwt)
+            return 'googlepaypass', 'text/uri-list', SAVE_URL % generated_jwt
         else:
             return False
 
-    def _comms(self):
-        if not hasattr(self, '__comms'):
-            self.__comms = Comms(self.event.settings.get('googlepaypasses_credentials'))
+    def _generate_fat(self, op: OrderPosition):
+        from pretix_googlepaypasses.tasks import reconcile_object
 
-        return self.__comms
+        googlepaypass = get_pass(op)
 
-    def _get_class(self, event: Event):
-        ticket_class = get_class_id(event)
+        if not googlepaypass:
+            # The object id has to be known before the pass is handed out, so that repeated downloads and the
+            # background upload all refer to the same object.
+            googlepaypass = record_pass(op, get_object_id(op), get_class_id(op.order.event))
+
+        output_object, payload, payload_hash = self._build_object(op, googlepaypass)
 
-        item = self._comms().get_item(ClassType.eventTicketClass, ticket_class)
+        if googlepaypass.payload_hash != payload_hash and claim_upload(googlepaypass.object_id, payload_hash):
+            reconcile_object.apply_async(args=(op.id,))
 
-        if item is None:
+        # The class is part of fat JWTs - its cache key changes along with the event's and organizer's settings
+        fingerprint = get_save_url_fingerprint(payload_hash, self._comms().key_id, django_settings.SITE_URL,
+                                               get_class_cache_key(op.order.event))
+        save_url = get_cached_save_url(googlepaypass.object_id, fingerprint)
+        if save_url:
+            return 'googlepaypass', 'text/uri-list', save_url
+
+        generated_jwt = self._comms().sign_jwt(
+            ButtonJWT(
+                origins=[django_settings.SITE_URL],
+                issuer=self._comms().client_email,
+                event_ticket_classes=[self._build_class(op.order.event)],
+                event_ticket_objects=[output_object],
+                skinny=False
+            )
+        )
+
+        if not generated_jwt:
             return False
-        elif not item:
-            return self._generate_class(event)
-        else:
+        elif len(generated_jwt) > MAX_JWT_LENGTH:
+            # The class and object do not fit into a save link - they go to Google through the API instead
+            return self._generate_skinny(op)
+
+        set_cached_save_url(googlepaypass.object_id, fingerprint, SAVE_URL % generated_jwt)
+        return 'googlepaypass', 'text/uri-list', SAVE_URL % generated_jwt
+
+    def generate_order(self, order: Order) -> Tuple[str, str, str]:
+        fat_jwt = self.event.settings.get('ticketoutput_googlepaypasses_fat_jwt', as_type=bool)
+
+        with timed(googlepaypasses_generation_seconds, 'generation',
+                   kind='fat_order_download' if fat_jwt else 'order_download'):
+            ops = list(order.positions_with_tickets)
+            if not ops:
+                return False
+
+            try:
+                if fat_jwt:
+                    jwts = self._generate_order_fat(order, ops)
+                else:
+                    jwts = self._generate_order_skinny(order, ops)
+            except CircuitOpenError:
+                self._unavailable()
+
+            if not jwts:
+                return False
+            elif len(jwts) == 1:
+                return 'googlepaypass', 'text/uri-list', SAVE_URL % jwts[0]
+
+            # The tickets do not fit into a single save link, so the customer gets a page with one button per part
+            return 'googlepaypass', 'text/uri-list', build_absolute_uri(
+                order.event, 'plugins:pretix_googlepaypasses:order', kwargs={
+                    'order': order.code,
+                    'secret': order.secret,
+                }
+            )
+
+    def _generate_order_skinny(self, order: Order, ops: list):
+        # All objects that are new or have changed go to Google in a single batch request instead of one PUT per
+        # position.
+        if not self._get_class(order.event):
+            return None
+
+        passes = get_passes(ops)
+        ticket_objects = []
+        changed = []
+
+        for op in ops:
+            googlepaypass = passes.get(op.pk)
+            output_object, payload, payload_hash = self._build_object(op, googlepaypass)
+            unchanged = googlepaypass and googlepaypass.payload_hash == payload_hash
+            record_cache_lookup('object', bool(unchanged))
+
+            ticket_objects.append({'id': payload['id'], 'classId': payload['class_id']})
+            if not unchanged:
+                changed.append((op, output_object, payload, payload_hash))
+
+        if changed:
+            with timed(googlepaypasses_generation_seconds, 'generation', kind='objects'):
+                statuses = self._comms().batch_put_items('eventTicketObject', [
+                    (payload['id'], output_object) for op, output_object, payload, payload_hash in changed
+                ])
+
+            failed = [payload['id'] for op, output_object, payload, payload_hash in changed
+                      if not is_success(statuses.get(payload['id'], 0))]
+            if failed:
+                record_error(failed, 'Could not write the object to Google')
+                return None
+
+            for op, output_object, payload, payload_hash in changed:
+                record_pass(op, payload['id'], payload['class_id'], payload_hash=payload_hash, synced=True)
+
+        return self._sign_jwts(ticket_objects)
+
+    def _generate_order_fat(self, order: Order, ops: list):
+        from pretix_googlepaypasses.tasks import refresh_objects
+
+        passes = get_passes(ops)
+        ticket_objects = []
+        changed = []
+
+        for op in ops:
+            if op.pk not in passes:
+                passes[op.pk] = record_pass(op, get_object_id(op), get_class_id(order.event))
+
+            output_object, payload, payload_hash = self._build_object(op, passes[op.pk])
+            ticket_objects.append(output_object)
+            if passes[op.pk].payload_hash != payload_hash:
+                changed.append((op.pk, passes[op.pk].object_id, payload_hash))
+
+        jwts = self._sign_jwts(ticket_objects, ticket_class=self._build_class(order.event))
+
+        if jwts and _too_long(jwts):
+            return self._generate_order_skinny(order, ops)
+        elif jwts and changed:
+            uploads = [op_id for op_id, object_id, payload_hash in changed if claim_upload(object_id, payload_hash)]
+            if uploads:
+                refresh_objects.apply_async(args=(uploads,))
+
+        return jwts
+
+    def get_order_jwts(self, order: Order):
+        # Signs the save links of an order from the recorded passes only, without talking to Google - used once an
+        # order's passes have been generated but do not fit into one link.
+        ops = list(order.positions_with_tickets)
+        passes = get_passes(ops)
+
+        if self.event.settings.get('ticketoutput_googlepaypasses_fat_jwt', as_type=bool):
+            jwts = self._sign_jwts(
+                [self._build_object(op, passes[op.pk])[0] for op in ops if op.pk in passes],
+                ticket_class=self._build_class(order.event)
+            )
+            # Too long for save links means generate_order has fallen back to uploading the objects
+            if not jwts or not _too_long(jwts):
+                return jwts
+
+        return self._sign_jwts([
+            {'id': passes[op.pk].object_id, 'classId': passes[op.pk].class_id} for op in ops if op.pk in passes
+        ])
+
+    def _sign_jwts(self, ticket_objects: list, ticket_class=None):
+        # Signs all objects into one JWT if possible and keeps splitting the objects in halves until every JWT fits
+        # into a save link.
+        if not ticket_objects:
+            return None
+
+        kwargs = {
+            'origins': [django_settings.SITE_URL],
+            'issuer': self._comms().client_email,
+            'event_ticket_objects': ticket_objects,
+            'skinny': ticket_class is None,
+        }
+        if ticket_class is not None:
+            kwargs['event_ticket_classes'] = [ticket_class]
+
+        generated_jwt = self._comms().sign_jwt(ButtonJWT(**kwargs))
+        if not generated_jwt:
+            return None
+        elif len(generated_jwt) <= MAX_JWT_LENGTH or len(ticket_objects) == 1:
+            return [generated_jwt]
+
+        half = len(ticket_objects) // 2
+        first = self._sign_jwts(ticket_objects[:half], ticket_class)
+        second = self._sign_jwts(ticket_objects[half:], ticket_class)
+        if first is None or second is None:
+            return None
+
+        return first + second
+
+    def _comms(self):
+        return get_comms(self.event.settings.get('googlepaypasses_credentials'))
+
+    def _get_class(self, event: Event):
+        ticket_class = get_class_id(event)
+
+        cached = is_class_cached(event)
+        record_cache_lookup('class', cached)
+        if cached:
             return ticket_class
 
+        with timed(googlepaypasses_generation_seconds, 'generation', kind='class'):
+            item = self._comms().get_item(ClassType.eventTicketClass, ticket_class)
+
+            if item is None:
+                return False
+            elif not item:
+                return self._generate_class(event)
+            else:
+                set_class_cached(event)
+                return ticket_class
+
     def _generate_class(self, event: Event):
-        gs = GlobalSettingsObject()
         class_name = get_class_id(event)
 
+        result = self._comms().put_item(ClassType.eventTicketClass, class_name, self._build_class(event))
+
+        if result:
+            set_class_cached(event)
+
+        return result
+
+    def _build_class(self, event: Event):
+        class_name = get_class_id(event)
+        labels = get_static_labels(event)
+
         output_class = EventTicketClass(
             event.organizer.name,
             class_name,
@@ -196,8 +477,8 @@ class WalletobjectOutput(BaseTicketOutput):
 
         output_class.homepage_uri(
             build_absolute_uri(event, 'presale:event.index'),
-            get_translated_string('Website', event.settings.get('locale')),
-            get_translated_dict('Website', event.settings.get('locales'))
+            labels['website'],
+            labels['website_i18n']
         )
 
         output_class.callback_url(build_absolute_uri(event.organizer, 'plugins:pretix_googlepaypasses:webhook'))
@@ -218,19 +499,21 @@ class WalletobjectOutput(BaseTicketOutput):
 
         output_class.hide_barcode(False)
 
-        if event.settings.get('ticketoutput_googlepaypasses_hero'):
+        hero_url = get_image_url(event, 'hero')
+        if hero_url:
             output_class.hero_image(
-                urljoin(django_settings.SITE_URL, event.settings.get('ticketoutput_googlepaypasses_hero').url),
+                hero_url,
                 str(event.name),
                 event.name,
             )
 
         output_class.hex_background_color(event.settings.get('primary_color'))
-        output_class.event_id('pretix-%s-%s-%s' % (gs.settings.get('update_check_id'), event.organizer.id, event.id))
+        output_class.event_id('pretix-%s-%s-%s' % (get_install_id(), event.organizer.id, event.id))
 
-        if event.settings.get('ticketoutput_googlepaypasses_logo'):
+        logo_url = get_image_url(event, 'logo')
+        if logo_url:
             output_class.logo(
-                urljoin(django_settings.SITE_URL, event.settings.get('ticketoutput_googlepaypasses_logo').url),
+                logo_url,
                 str(event.name),
                 event.name,
             )
@@ -263,63 +546,85 @@ class WalletobjectOutput(BaseTicketOutput):
         if event.seating_plan_id is not None:
             output_class.seat_label(Seat.seat)
 
-        return self._comms().put_item(ClassType.eventTicketClass, class_name, output_class)
+        return output_class
 
-    def _get_object(self, op: OrderPosition):
-        meta_info = json.loads(op.meta_info or '{}')
+    def _get_object(self, op: OrderPosition, force=False):
+        return self._get_object_with_hash(op, force)[0]
 
-        ticket_object = self._generate_object(op)
+    def _get_object_with_hash(self, op: OrderPosition, force=False):
+        googlepaypass = get_pass(op)
 
-        if ticket_object and 'googlepaypass' not in meta_info:
-            meta_info['googlepaypass'] = ticket_object['id']
-            op.meta_info = json.dumps(meta_info)
-            op.save(update_fields=['meta_info'])
-            return ticket_object
-        elif ticket_object and 'googlepaypass' in meta_info:
-            return ticket_object
-        else:
-            return False
+        with timed(googlepaypasses_generation_seconds, 'generation', kind='object'):
+            ticket_object, payload_hash = self._generate_object(op, googlepaypass, force)
+
+        if not ticket_object:
+            if googlepaypass:
+                record_error([googlepaypass.object_id], 'Could not write the object to Google')
+            return False, payload_hash
+
+        if not googlepaypass or googlepaypass.object_id != ticket_object['id'] or googlepaypass.payload_hash != payload_hash:
+            record_pass(op, ticket_object['id'], get_class_id(op.order.event), payload_hash=payload_hash, synced=True)
+
+        return ticket_object, payload_hash
+
+    def _generate_object(self, op: OrderPosition, googlepaypass: GooglePayPass = None, force=False):
+        output_object, payload, payload_hash = self._build_object(op, googlepaypass)
+
+        # The payload hash is only recorded once the object has been written to Google
+        unchanged = not force and googlepaypass and googlepaypass.payload_hash == payload_hash
+        record_cache_lookup('object', bool(unchanged))
+        if unchanged:
+            return {'id': payload['id'], 'classId': payload['class_id']}, payload_hash
+
+        return self._comms().put_item(ObjectType.eventTicketObject, payload['id'], output_object), payload_hash
 
-    def _generate_object(self, op: OrderPosition):
+    def _build_object(self, op: OrderPosition, googlepaypass: GooglePayPass = None):
         class_name = get_class_id(op.order.event)
-        meta_info = json.loads(op.meta_info or '{}')
 
-        if 'googlepaypass' in meta_info:
-            object_name = meta_info['googlepaypass']
+        if googlepaypass:
+            object_name = googlepaypass.object_id
         else:
             object_name = get_object_id(op)
 
-        output_object = EventTicketObject(object_name, class_name, ObjectState.active, op.order.event.settings.locale)
-
-        output_object.barcode(Barcode.qrCode, op.secret, op.secret)
-
-        output_object.reservation_info("%s-%s" % (op.order.event.slug, op.order.code))
-        output_object.ticket_holder_name(op.attendee_name or (op.addon_to.attendee_name if op.addon_to else ''))
-        output_object.ticket_number(op.secret)
-        output_object.ticket_type(
-            get_translated_dict(
+        # Everything that ends up in the object is also collected here, so we can tell whether the object stored at
+        # Google is still up to date and skip the upsert if it is.
+        payload = {
+            'id': object_name,
+            'class_id': class_name,
+            'state': ObjectState.active,
+            'locale': op.order.event.settings.locale,
+            'barcode': op.secret,
+            'reservation_info': "%s-%s" % (op.order.event.slug, op.order.code),
+            'ticket_holder_name': op.attendee_name or (op.addon_to.attendee_name if op.addon_to else ''),
+            'ticket_type': get_translated_dict(
                 str(op.item) + (" – " + str(op.variation.value) if op.variation else ""),
                 op.order.event.settings.get('locales')
-            )
-        )
+            ),
+        }
 
         places = django_settings.CURRENCY_PLACES.get(op.order.event.currency, 2)
-        output_object.face_value(int(op.price * 1000 ** places), op.order.event.currency)
+        payload['face_value'] = (int(op.price * 1000 ** places), op.order.event.currency)
 
         if op.order.event.seating_plan_id is not None:
             if op.seat:
-                output_object.seat(
-                    get_translated_dict(
-                        _(str(op.seat)),
-                        op.order.event.settings.get('locales')
-                    )
+                payload['seat'] = get_translated_dict(
+                    str(op.seat),
+                    op.order.event.settings.get('locales')
                 )
             else:
-                output_object.seat(
-                    get_translated_dict(
-                        _('General admission'),
-                        op.order.event.settings.get('locales')
-                    )
-                )
+                payload['seat'] = get_static_labels(op.order.event)['general_admission']
+
+        output_object = EventTicketObject(object_name, class_name, payload['state'], payload['locale'])
+
+        output_object.barcode(Barcode.qrCode, payload['barcode'], payload['barcode'])
+
+        output_object.reservation_info(payload['reservation_info'])
+        output_object.ticket_holder_name(payload['ticket_holder_name'])
+        output_object.ticket_number(payload['barcode'])
+        output_object.ticket_type(payload['ticket_type'])
+        output_object.face_value(*payload['face_value'])
+
+        if 'seat' in payload:
+            output_object.seat(payload['seat'])
 
-        return self._comms().put_item(ObjectType.eventTicketObject, object_name, output_object)
+        return output_object, payload, get_payload_hash(payload)
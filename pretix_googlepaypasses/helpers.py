@@ -1,47 +1,294 @@
+import hashlib
+import json
 import uuid
+from functools import lru_cache
 
-from django.utils import translation
-from django.utils.translation import ugettext
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.utils.timezone import now
+from django.utils.translation import trans_real, ugettext_noop
 from pretix.base.models import Event, OrderPosition
 from pretix.base.settings import GlobalSettingsObject
+from pretix.multidomain.urlreverse import build_absolute_uri
+from pretix_googlepaypasses.config import get_config
+from pretix_googlepaypasses.metrics import record_cache_lookup
+from pretix_googlepaypasses.models import GooglePayPass
 
+CLASS_CACHE_TIMEOUT = 24 * 3600
+# The prefixes are invalidated on every change of the slugs or the issuer id, this only bounds what a missed change costs
+ID_PREFIX_CACHE_TIMEOUT = 300
+# Part of every prefix's cache key - rotated when the global issuer id changes, which affects all events at once
+ID_PREFIX_VERSION_KEY = 'googlepaypasses_id_prefix_version'
+TRANSLATION_CACHE_SIZE = 1024
+IMAGE_HASH_CACHE_TIMEOUT = 30 * 24 * 3600
+# Save links do not expire on their own, but the cache should not hand out a JWT signed with a key that has been
+# rotated in the meantime for long
+SAVE_URL_CACHE_TIMEOUT = 3600
+# Long enough for the background upload of a fat JWT's object to record the new payload hash
+UPLOAD_CLAIM_TIMEOUT = 60
+# Set by googlepaypasses_backfill once every pass from OrderPosition.meta_info is in the GooglePayPass table
+BACKFILL_DONE_KEY = 'googlepaypasses_backfill_done'
+WEBSITE = ugettext_noop('Website')
+GENERAL_ADMISSION = ugettext_noop('General admission')
 
-def get_class_id(event: Event):
-    gs = GlobalSettingsObject()
-    if not gs.settings.get('update_check_id'):
-        gs.settings.set('update_check_id', uuid.uuid4().hex)
+_install_id = None
+
+
+def get_install_id():
+    # The install id never changes once it has been generated, so it is only read from the global settings once per
+    # process.
+    global _install_id
+
+    if _install_id is None:
+        gs = GlobalSettingsObject()
+        if not gs.settings.get('update_check_id'):
+            gs.settings.set('update_check_id', uuid.uuid4().hex)
+        _install_id = gs.settings.get('update_check_id')
+
+    return _install_id
+
+
+def _id_prefix_cache_key(event: Event):
+    # The slugs are part of the key, so renaming an organizer or event invalidates the prefix on its own. Should the
+    # version get evicted, a new one is generated, which only invalidates more than necessary.
+    version = cache.get_or_set(ID_PREFIX_VERSION_KEY, uuid.uuid4().hex, None)
+    return 'googlepaypasses_id_prefix_%s_%s_%s_%s' % (version, event.pk, event.organizer.slug, event.slug)
+
+
+def get_id_prefix(event: Event):
+    slugs = (event.organizer.slug, event.slug)
+    memo = getattr(event, '_googlepaypasses_id_prefix', None)
+    if memo and memo[0] == slugs:
+        return memo[1]
 
-    issuer_id = event.settings.get('googlepaypasses_issuer_id')
+    cache_key = _id_prefix_cache_key(event)
+    prefix = cache.get(cache_key)
+    if prefix is None:
+        prefix = "%s.pretix-%s-%s-%s" % (event.settings.get('googlepaypasses_issuer_id'), get_install_id(),
+                                         event.organizer.slug, event.slug)
+        cache.set(cache_key, prefix, ID_PREFIX_CACHE_TIMEOUT)
 
-    return "%s.pretix-%s-%s-%s" % (issuer_id, gs.settings.get('update_check_id'), event.organizer.slug, event.slug)
+    event._googlepaypasses_id_prefix = (slugs, prefix)
+    return prefix
+
+
+def invalidate_id_prefix(event: Event):
+    cache.delete(_id_prefix_cache_key(event))
+    if hasattr(event, '_googlepaypasses_id_prefix'):
+        del event._googlepaypasses_id_prefix
+
+
+def invalidate_all_id_prefixes():
+    cache.set(ID_PREFIX_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_class_id(event: Event):
+    return get_id_prefix(event)
 
 
 def get_object_id(op: OrderPosition):
-    gs = GlobalSettingsObject()
-    if not gs.settings.get('update_check_id'):
-        gs.settings.set('update_check_id', uuid.uuid4().hex)
+    return "%s-%s-%s-%s" % (get_id_prefix(op.order.event), op.order.code, op.positionid, uuid.uuid4().hex)
 
-    issuer_id = op.order.event.settings.get('googlepaypasses_issuer_id')
 
-    return "%s.pretix-%s-%s-%s-%s-%s-%s" % (issuer_id, gs.settings.get('update_check_id'),
-                                            op.order.event.organizer.slug, op.order.event.slug,
-                                            op.order.code, op.positionid, uuid.uuid4().hex)
+def get_class_cache_key(event: Event):
+    # The version is rotated whenever the event's or organizer's settings change, which orphans all previously
+    # cached class states of the event at once.
+    version_key = 'googlepaypasses_class_version_%s' % event.pk
+    version = cache.get(version_key)
+    if not version:
+        version = uuid.uuid4().hex
+        cache.set(version_key, version, None)
 
+    return 'googlepaypasses_class_%s_%s' % (get_class_id(event), version)
 
-def get_translated_dict(string, locales):
-    translated = {}
 
-    for locale in locales:
-        translation.activate(locale)
-        translated[locale] = ugettext(string)
-        translation.deactivate()
+def set_class_cached(event: Event):
+    cache.set(get_class_cache_key(event), True, CLASS_CACHE_TIMEOUT)
+
+
+def is_class_cached(event: Event):
+    return bool(cache.get(get_class_cache_key(event)))
+
+
+def invalidate_class_cache(event: Event):
+    cache.delete('googlepaypasses_class_version_%s' % event.pk)
+
+
+def _save_url_cache_key(object_id: str):
+    return 'googlepaypasses_save_url_%s' % hashlib.md5(object_id.encode('utf-8')).hexdigest()
+
+
+def get_save_url_fingerprint(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def get_cached_save_url(object_id: str, fingerprint: str):
+    # There is only one entry per object, which also makes it easy to drop when the object is shredded or refreshed.
+    # The fingerprint covers everything else that went into the signed JWT.
+    cached = cache.get(_save_url_cache_key(object_id))
+    hit = cached is not None and cached[0] == fingerprint
+    record_cache_lookup('save_url', hit)
+    return cached[1] if hit else None
+
+
+def set_cached_save_url(object_id: str, fingerprint: str, url: str):
+    cache.set(_save_url_cache_key(object_id), (fingerprint, url), SAVE_URL_CACHE_TIMEOUT)
+
+
+def invalidate_save_urls(object_ids: list):
+    cache.delete_many([_save_url_cache_key(object_id) for object_id in object_ids])
+
+
+def claim_upload(object_id: str, payload_hash: str):
+    # Until the upload has recorded the new payload hash, every download of the pass would queue another one
+    key = 'googlepaypasses_upload_%s' % hashlib.md5(('%s|%s' % (object_id, payload_hash)).encode('utf-8')).hexdigest()
+    return cache.add(key, True, UPLOAD_CLAIM_TIMEOUT)
+
+
+def get_image_name(event: Event, kind: str):
+    value = event.settings.get('ticketoutput_googlepaypasses_%s' % kind, as_type=str)
+    if not value or not value.startswith('file://'):
+        return None
+    return value[7:]
+
 
-    return translated
+def get_image_hash(name: str):
+    # pretix stores every upload under a new name, so the hash of a stored file never changes and only has to be
+    # computed once.
+    cache_key = 'googlepaypasses_image_hash_%s' % hashlib.md5(name.encode('utf-8')).hexdigest()
+    image_hash = cache.get(cache_key)
+
+    if image_hash is None:
+        with default_storage.open(name, 'rb') as f:
+            image_hash = hashlib.sha256(f.read()).hexdigest()[:32]
+        cache.set(cache_key, image_hash, IMAGE_HASH_CACHE_TIMEOUT)
+
+    return image_hash
+
+
+def get_image_url(event: Event, kind: str):
+    # The URL changes with the image's content, so it can be cached forever by Google, the devices and any CDN in
+    # between, and refreshing a class does not make anybody download the image again.
+    name = get_image_name(event, kind)
+    if not name:
+        return None
+
+    return build_absolute_uri(event, 'plugins:pretix_googlepaypasses:image', kwargs={
+        'kind': kind,
+        'image_hash': get_image_hash(name),
+    })
+
+
+def _legacy_pass_id(op: OrderPosition):
+    try:
+        meta_info = json.loads(op.meta_info or '{}')
+    except ValueError:
+        return None, None
+    return meta_info.get('googlepaypass'), meta_info.get('googlepaypass_hash')
+
+
+def get_pass(op: OrderPosition):
+    return get_passes([op]).get(op.pk)
+
+
+def get_passes(ops: list):
+    # Returns the active pass of each position. Positions that have not been migrated yet still carry their pass id
+    # in meta_info - those are moved into the table the first time they are looked at, unless the pass recorded
+    # there has already been deactivated.
+    passes = {
+        p.position_id: p
+        for p in GooglePayPass.objects.filter(position__in=ops, state=GooglePayPass.STATE_ACTIVE)
+    }
+
+    legacy = {}
+    for op in ops:
+        if op.pk not in passes:
+            object_id, payload_hash = _legacy_pass_id(op)
+            if object_id:
+                legacy[object_id] = (op, payload_hash)
+
+    if legacy:
+        known = set(GooglePayPass.objects.filter(object_id__in=list(legacy)).values_list('object_id', flat=True))
+        for object_id, (op, payload_hash) in legacy.items():
+            if object_id in known:
+                continue
+            # Two downloads of the same position may get here at the same time - get_or_create copes with losing
+            googlepaypass = GooglePayPass.objects.get_or_create(object_id=object_id, defaults={
+                'class_id': get_class_id(op.order.event),
+                'position': op,
+                'event': op.order.event,
+                'payload_hash': payload_hash or '',
+            })[0]
+            if googlepaypass.state == GooglePayPass.STATE_ACTIVE:
+                passes[op.pk] = googlepaypass
+
+    return passes
+
+
+def record_pass(op: OrderPosition, object_id: str, class_id: str, payload_hash: str = None, synced=False):
+    defaults = {
+        'position': op,
+        'event': op.order.event,
+        'class_id': class_id,
+        'state': GooglePayPass.STATE_ACTIVE,
+    }
+    if payload_hash is not None:
+        defaults['payload_hash'] = payload_hash
+    if synced:
+        defaults['last_synced'] = now()
+        defaults['last_error'] = ''
+
+    return GooglePayPass.objects.update_or_create(object_id=object_id, defaults=defaults)[0]
+
+
+def record_synced(object_id: str, payload_hash: str):
+    GooglePayPass.objects.filter(object_id=object_id).update(payload_hash=payload_hash, last_synced=now(),
+                                                             last_error='')
+
+
+def record_error(object_ids: list, error: str):
+    GooglePayPass.objects.filter(object_id__in=object_ids).update(last_error=error)
+
+
+def deactivate_passes(object_ids: list):
+    invalidate_save_urls(object_ids)
+    GooglePayPass.objects.filter(object_id__in=object_ids).update(
+        state=GooglePayPass.STATE_INACTIVE, last_synced=now(), last_error=''
+    )
+
+
+def get_config_flag(option: str):
+    return get_config(option, False)
+
+
+def get_payload_hash(payload: dict):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_translated_dict(string, locales):
+    return dict(_translate(str(string), tuple(locales)))
 
 
 def get_translated_string(string, locale):
-    translation.activate(locale)
-    translated = ugettext(string)
-    translation.deactivate()
+    return _translate(str(string), (locale,))[locale]
+
+
+def get_static_labels(event: Event):
+    labels = _get_static_labels(event.settings.get('locale'), tuple(event.settings.get('locales')))
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in labels.items()}
+
+
+@lru_cache(maxsize=TRANSLATION_CACHE_SIZE)
+def _translate(string, locales):
+    # Looks the string up in each locale's catalog directly instead of activating the locales one after the other,
+    # which would also clobber the thread's active translation.
+    return {locale: trans_real.translation(locale).gettext(string) for locale in locales}
+
 
-    return translated
+@lru_cache(maxsize=64)
+def _get_static_labels(locale, locales):
+    return {
+        'website': _translate(WEBSITE, (locale,))[locale],
+        'website_i18n': _translate(WEBSITE, locales),
+        'general_admission': _translate(GENERAL_ADMISSION, locales),
+    }
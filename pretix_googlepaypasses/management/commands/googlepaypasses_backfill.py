@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPosition
+from pretix.base.settings import GlobalSettingsObject
+from pretix_googlepaypasses.helpers import BACKFILL_DONE_KEY, get_class_id
+from pretix_googlepaypasses.models import GooglePayPass
+
+
+class Command(BaseCommand):
+    help = "Migrate the Google Pay Passes state stored in OrderPosition.meta_info into the GooglePayPass table, chunk by chunk"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        last_id = 0
+        total = 0
+        class_ids = {}
+
+        while True:
+            ops = list(
+                OrderPosition.objects.filter(
+                    id__gt=last_id, meta_info__contains='"googlepaypass"'
+                ).select_related('order', 'order__event', 'order__event__organizer').order_by('id')[:options['chunk_size']]
+            )
+
+            if not ops:
+                break
+
+            passes = []
+            for op in ops:
+                meta_info = json.loads(op.meta_info or '{}')
+                if 'googlepaypass' not in meta_info:
+                    continue
+
+                event = op.order.event
+                if event.pk not in class_ids:
+                    class_ids[event.pk] = get_class_id(event)
+
+                passes.append(GooglePayPass(
+                    object_id=meta_info['googlepaypass'],
+                    class_id=class_ids[event.pk],
+                    position=op,
+                    event=event,
+                    payload_hash=meta_info.get('googlepaypass_hash', ''),
+                    last_synced=now() if meta_info.get('googlepaypass_hash') else None,
+                ))
+
+            GooglePayPass.objects.bulk_create(passes, ignore_conflicts=True)
+            total += len(passes)
+            last_id = ops[-1].id
+            print('Processed positions up to id %d - %d passes so far' % (last_id, total))
+
+        # Reconciliation only repairs once every pass is known to the table
+        GlobalSettingsObject().settings.set(BACKFILL_DONE_KEY, now().isoformat())
+        print('Done. %d passes recorded.' % total)
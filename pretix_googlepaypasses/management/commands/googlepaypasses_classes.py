@@ -1,7 +1,9 @@
+import json
+
 from django.core.management.base import BaseCommand
 from pretix.base.settings import GlobalSettingsObject
+from pretix_googlepaypasses.comms import get_comms
 from walletobjects import ClassType
-from walletobjects.comms import Comms
 
 
 class Command(BaseCommand):
@@ -10,16 +12,21 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('action', type=str, nargs='?')
         parser.add_argument('param', type=str, nargs='?')
+        parser.add_argument('--json', action='store_true', help='Print one JSON document per line')
+        parser.add_argument('--page-size', type=int, default=100)
 
     def handle(self, *args, **options):
         gs = GlobalSettingsObject()
-        comms = Comms(gs.settings.get('googlepaypasses_credentials'))
+        comms = get_comms(gs.settings.get('googlepaypasses_credentials'))
 
         if options['action'] == 'list':
-            result = comms.list_items(ClassType.eventTicketClass, issuer_id=gs.settings.googlepaypasses_issuer_id)
-
-            for resource in result['resources']:
-                print(resource['id'])
+            for resource in comms.iter_items(ClassType.eventTicketClass,
+                                             issuer_id=gs.settings.googlepaypasses_issuer_id,
+                                             page_size=options['page_size']):
+                if options['json']:
+                    print(json.dumps(resource), flush=True)
+                else:
+                    print(resource['id'], flush=True)
         elif options['action'] == 'print':
             if not options['param']:
                 print('No classID specified')
@@ -1,52 +1,176 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 
 from django.core.management.base import BaseCommand
 from pretix.base.settings import GlobalSettingsObject
-from walletobjects import EventTicketObject
-from walletobjects.comms import Comms
+from pretix_googlepaypasses.comms import ApiError, get_comms
+from pretix_googlepaypasses.ratelimit import RetryableError, background_lane
+from walletobjects import ClassType, EventTicketObject
 from walletobjects.constants import ObjectState, ObjectType
 
+_DONE = object()
+
 
 class Command(BaseCommand):
     help = "Query the Google Pay API for Passes for registered eventTicketObjects"
 
     def add_arguments(self, parser):
         parser.add_argument('action', type=str, nargs='?')
-        parser.add_argument('param', type=str, nargs='?')
+        parser.add_argument('param', type=str, nargs='*',
+                            help='classIDs for list, an objectID for print, objectIDs (or - for stdin) for shred')
+        parser.add_argument('--all-classes', action='store_true',
+                            help='list: list the objects of all classes of the issuer')
+        parser.add_argument('--class', dest='class_id', type=str,
+                            help='shred: shred all objects of the given class')
+        parser.add_argument('--json', action='store_true', help='list: print one JSON document per line')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--checkpoint', type=str,
+                            help='shred: file to record shredded objects in, so an interrupted run can be resumed')
 
     def handle(self, *args, **options):
         gs = GlobalSettingsObject()
-        comms = Comms(gs.settings.get('googlepaypasses_credentials'))
+        self.comms = get_comms(gs.settings.get('googlepaypasses_credentials'))
+        self.options = options
 
         if options['action'] == 'list':
-            if not options['param']:
-                print('No classID specified')
+            if options['all_classes']:
+                class_ids = (c['id'] for c in self.comms.iter_items(
+                    ClassType.eventTicketClass, issuer_id=gs.settings.googlepaypasses_issuer_id,
+                    page_size=options['page_size']
+                ))
+            elif options['param']:
+                class_ids = options['param']
             else:
-                result = comms.list_items(ObjectType.eventTicketObject, class_id=options['param'])
+                print('No classID specified')
+                return
 
-                for resource in result['resources']:
-                    print('%s - hasUsers: %r - state: %r' % (resource['id'], resource['hasUsers'], resource['state']))
+            self.list_objects(class_ids)
         elif options['action'] == 'print':
             if not options['param']:
                 print('No objectID specified')
             else:
-                print(comms.get_item(ObjectType.eventTicketObject, options['param']))
+                print(self.comms.get_item(ObjectType.eventTicketObject, options['param'][0]))
         elif options['action'] == 'shred':
-            if not options['param']:
+            if options['class_id']:
+                objects = ((o['id'], o['classId']) for o in self.comms.iter_items(
+                    ObjectType.eventTicketObject, class_id=options['class_id'], page_size=options['page_size']
+                ))
+            elif options['param'] == ['-']:
+                objects = ((line.strip(), None) for line in sys.stdin if line.strip())
+            elif options['param']:
+                objects = ((object_id, None) for object_id in options['param'])
+            else:
                 print('No objectID specified')
+                return
+
+            self.shred_objects(objects)
+        else:
+            print('Unknown action. Use either \'list <classID> [<classID> ...]\', \'list --all-classes\', '
+                  '\'print <objectID>\', \'shred <objectID> [<objectID> ...]\', \'shred -\' or '
+                  '\'shred --class <classID>\'')
+
+    def list_objects(self, class_ids):
+        # The pages of every class are fetched by a bounded pool of workers and streamed through a queue, so the
+        # output starts right away and memory use does not depend on the number of objects.
+        queue = Queue(maxsize=self.options['page_size'] * self.options['workers'])
+
+        def worker(class_id):
+            try:
+                for resource in self.comms.iter_items(ObjectType.eventTicketObject, class_id=class_id,
+                                                      page_size=self.options['page_size']):
+                    queue.put(resource)
+            except ApiError as e:
+                self.stderr.write(str(e))
+
+        def produce():
+            try:
+                with ThreadPoolExecutor(max_workers=self.options['workers']) as executor:
+                    for class_id in class_ids:
+                        executor.submit(worker, class_id)
+            except ApiError as e:
+                self.stderr.write(str(e))
+            finally:
+                queue.put(_DONE)
+
+        threading.Thread(target=produce, daemon=True).start()
+
+        while True:
+            resource = queue.get()
+            if resource is _DONE:
+                break
+
+            if self.options['json']:
+                print(json.dumps(resource), flush=True)
             else:
-                item = comms.get_item(ObjectType.eventTicketObject, options['param'])
+                print('%s - hasUsers: %r - state: %r' % (resource['id'], resource.get('hasUsers'),
+                                                         resource.get('state')), flush=True)
 
-                if not item:
-                    print('Could not retrieve object %s' % (options['param']))
-                    return
+    def shred_objects(self, objects):
+        done = set()
+        checkpoint = None
+        if self.options['checkpoint']:
+            if os.path.exists(self.options['checkpoint']):
+                with open(self.options['checkpoint']) as f:
+                    done = {line.strip() for line in f if line.strip()}
+                self.stderr.write('Resuming - skipping %d objects that have already been shredded' % len(done))
+            checkpoint = open(self.options['checkpoint'], 'a')
 
-                class_id = item['class_id']
+        lock = threading.Lock()
+        counts = {'shredded': 0, 'failed': 0}
 
-                output_object = EventTicketObject(options['param'], class_id, ObjectState.inactive, 'EN')
+        def shred(object_id, class_id):
+            with background_lane():
+                try:
+                    if not class_id:
+                        item = self.comms.get_item(ObjectType.eventTicketObject, object_id)
+                        if not item:
+                            return object_id, False
+                        class_id = item['classId']
 
-                if not comms.put_item(ObjectType.eventTicketObject, options['param'], output_object):
-                    print('Something went wrong when shredding the object %s' % options['param'])
-                else:
-                    print('Successfully shredded object %s' % (options['param']))
-        else:
-            print('Unknown action. Use either \'list <classID>\', \'print <objectID>\' or \'shred <objectID>\'')
+                    output_object = EventTicketObject(object_id, class_id, ObjectState.inactive, 'EN')
+                    return object_id, bool(self.comms.put_item(ObjectType.eventTicketObject, object_id,
+                                                               output_object))
+                except RetryableError:
+                    return object_id, False
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.options['workers']) as executor:
+                pending = set()
+                for object_id, class_id in objects:
+                    if object_id in done:
+                        continue
+
+                    pending.add(executor.submit(shred, object_id, class_id))
+                    if len(pending) >= self.options['workers'] * 4:
+                        finished = next(as_completed(pending))
+                        pending.remove(finished)
+                        self._shred_done(finished, checkpoint, lock, counts)
+
+                for finished in as_completed(pending):
+                    self._shred_done(finished, checkpoint, lock, counts)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        print('Shredded %d objects, %d failed' % (counts['shredded'], counts['failed']))
+
+    def _shred_done(self, future, checkpoint, lock, counts):
+        object_id, success = future.result()
+
+        with lock:
+            if success:
+                counts['shredded'] += 1
+                if checkpoint:
+                    checkpoint.write(object_id + '\n')
+                    checkpoint.flush()
+            else:
+                counts['failed'] += 1
+                self.stderr.write('Could not shred object %s' % object_id)
+
+            if (counts['shredded'] + counts['failed']) % 100 == 0:
+                self.stderr.write('%d shredded, %d failed' % (counts['shredded'], counts['failed']))
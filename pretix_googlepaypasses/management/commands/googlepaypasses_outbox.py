@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+from pretix_googlepaypasses.outbox import drain, get_outbox_stats, retry_failed
+from pretix_googlepaypasses.ratelimit import background_lane
+
+
+class Command(BaseCommand):
+    help = "Show the pending writes to the Google Pay API for Passes, or process them right away"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', type=str, nargs='?', default='status', choices=['status', 'drain', 'retry'],
+                            help='status: show depth and age of the outbox, drain: process the due entries now, '
+                                 'retry: hand entries that have been given up on back to the worker')
+        parser.add_argument('--max-seconds', type=int, default=300, help='drain: stop after this many seconds')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        if options['action'] == 'drain':
+            with background_lane():
+                stats = drain(max_seconds=options['max_seconds'])
+            for key, value in sorted(stats.items()):
+                print('%s: %d' % (key, value))
+            return
+        elif options['action'] == 'retry':
+            print('%d entries will be retried.' % retry_failed())
+            return
+
+        stats = get_outbox_stats()
+        if not stats:
+            print('The outbox is empty.')
+            return
+
+        print('%-16s %-8s %8s %8s %12s %12s' % ('operation', 'state', 'depth', 'due', 'oldest (s)', 'max attempts'))
+        for row in stats:
+            print('%-16s %-8s %8d %8d %12.0f %12d' % (
+                row['operation'], row['state'], row['depth'], row['due'], row['oldest_age'], row['max_attempts']
+            ))
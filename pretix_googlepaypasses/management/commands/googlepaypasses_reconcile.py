@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+from pretix_googlepaypasses.reconcile import reconcile
+
+
+class Command(BaseCommand):
+    help = "Compare the locally recorded Google Pay Passes with the eventTicketObjects known to Google"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Deactivate orphaned objects at Google and forget passes that are missing there')
+        parser.add_argument('--max-pages', type=int, default=None,
+                            help='Stop after this many pages - the next run continues from the checkpoint')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from scratch')
+        parser.add_argument('--page-size', type=int, default=100)
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        stats = reconcile(
+            repair=options['repair'],
+            max_pages=options['max_pages'],
+            restart=options['restart'],
+            page_size=options['page_size'],
+        )
+
+        for key, value in sorted(stats.items()):
+            print('%s: %d' % (key, value))
+
+        if not stats.get('completed'):
+            print('Not finished yet - run again to continue from the checkpoint.')
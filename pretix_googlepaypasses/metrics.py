@@ -0,0 +1,139 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings as django_settings
+from pretix.base.metrics import Counter, Gauge, Histogram
+from pretix_googlepaypasses.config import get_config
+
+logger = logging.getLogger(__name__)
+
+# The metrics end up in pretix's metrics endpoint. Every metric needs at least one label, pretix cannot render
+# unlabelled ones.
+googlepaypasses_api_calls_total = Counter(
+    'googlepaypasses_api_calls_total', 'Calls to the Google Pay API for Passes',
+    ['endpoint', 'operation', 'status', 'issuer']
+)
+googlepaypasses_api_duration_seconds = Histogram(
+    'googlepaypasses_api_duration_seconds', 'Duration of calls to the Google Pay API for Passes',
+    ['endpoint', 'operation']
+)
+googlepaypasses_jwt_signing_seconds = Histogram(
+    'googlepaypasses_jwt_signing_seconds', 'Time spent signing Google Pay Passes JWTs', ['account']
+)
+googlepaypasses_generation_seconds = Histogram(
+    'googlepaypasses_generation_seconds', 'Time spent generating Google Pay Passes and their classes and objects',
+    ['kind']
+)
+googlepaypasses_cache_lookups_total = Counter(
+    'googlepaypasses_cache_lookups_total', 'Cache lookups of the Google Pay Passes plugin', ['cache', 'result']
+)
+googlepaypasses_ratelimit_wait_seconds = Histogram(
+    'googlepaypasses_ratelimit_wait_seconds', 'Time spent waiting for the Google Pay Passes rate limit', ['lane']
+)
+googlepaypasses_outbox_operations_total = Counter(
+    'googlepaypasses_outbox_operations_total', 'Operations processed from the Google Pay Passes outbox',
+    ['operation', 'result']
+)
+# The share of coalesced triggers is the rate of coalesced to triggered
+googlepaypasses_debounce_total = Counter(
+    'googlepaypasses_debounce_total', 'Triggers of debounced Google Pay Passes tasks and what became of them',
+    ['task', 'result']
+)
+# 0 - closed, 1 - open, 2 - half-open
+googlepaypasses_circuit_breaker_state = Gauge(
+    'googlepaypasses_circuit_breaker_state', 'State of the circuit breaker in front of the Google Pay API for Passes',
+    ['issuer']
+)
+googlepaypasses_circuit_breaker_rejections_total = Counter(
+    'googlepaypasses_circuit_breaker_rejections_total', 'Calls to the Google Pay API for Passes that were failed fast',
+    ['issuer', 'lane']
+)
+
+_slow_call_threshold = None
+
+
+def _metrics_enabled():
+    return getattr(django_settings, 'METRICS_ENABLED', False)
+
+
+def get_slow_call_threshold():
+    # slow_call_threshold in the [googlepaypasses] section of pretix.cfg, in seconds - calls taking longer are logged.
+    global _slow_call_threshold
+
+    if _slow_call_threshold is None:
+        _slow_call_threshold = get_config('slow_call_threshold', 0.0)
+
+    return _slow_call_threshold
+
+
+def _log_if_slow(kind: str, duration: float, **labels):
+    threshold = get_slow_call_threshold()
+    if threshold and duration >= threshold:
+        logger.warning(
+            'Slow Google Pay Passes %s: %s duration_ms=%.1f', kind,
+            ' '.join('%s=%s' % (key, value) for key, value in sorted(labels.items())), duration * 1000,
+            extra={'googlepaypasses_kind': kind, 'googlepaypasses_duration': duration, 'googlepaypasses_labels': labels}
+        )
+
+
+def record_api_call(endpoint: str, operation: str, status, issuer: str, duration: float):
+    if _metrics_enabled():
+        googlepaypasses_api_calls_total.inc(1, endpoint=endpoint, operation=operation, status=status, issuer=issuer)
+        googlepaypasses_api_duration_seconds.observe(duration, endpoint=endpoint, operation=operation)
+
+    _log_if_slow('api_call', duration, endpoint=endpoint, operation=operation, status=status, issuer=issuer)
+
+
+def record_api_statuses(endpoint: str, operation: str, statuses, issuer: str):
+    if _metrics_enabled():
+        for status in statuses:
+            googlepaypasses_api_calls_total.inc(1, endpoint=endpoint, operation=operation, status=status,
+                                                issuer=issuer)
+
+
+def record_cache_lookup(cache_name: str, hit: bool):
+    if _metrics_enabled():
+        googlepaypasses_cache_lookups_total.inc(1, cache=cache_name, result='hit' if hit else 'miss')
+
+
+def record_ratelimit_wait(lane: str, duration: float):
+    if _metrics_enabled():
+        googlepaypasses_ratelimit_wait_seconds.observe(duration, lane=lane)
+
+    _log_if_slow('ratelimit_wait', duration, lane=lane)
+
+
+def record_outbox_operations(operation: str, done: int, failed: int):
+    if _metrics_enabled():
+        if done:
+            googlepaypasses_outbox_operations_total.inc(done, operation=operation, result='done')
+        if failed:
+            googlepaypasses_outbox_operations_total.inc(failed, operation=operation, result='failed')
+
+
+def record_debounce(task: str, result: str):
+    if _metrics_enabled():
+        googlepaypasses_debounce_total.inc(1, task=task, result=result)
+
+
+def record_breaker_state(issuer: str, state: int):
+    if _metrics_enabled():
+        googlepaypasses_circuit_breaker_state.set(state, issuer=issuer)
+
+
+def record_breaker_rejection(issuer: str, lane: str):
+    if _metrics_enabled():
+        googlepaypasses_circuit_breaker_rejections_total.inc(1, issuer=issuer, lane=lane)
+
+
+@contextmanager
+def timed(histogram: Histogram, kind: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        if _metrics_enabled():
+            histogram.observe(duration, **labels)
+        _log_if_slow(kind, duration, **labels)
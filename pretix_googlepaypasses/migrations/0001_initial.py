@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('pretixbase', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GooglePayPass',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('object_id', models.CharField(max_length=255, unique=True)),
+                ('class_id', models.CharField(db_index=True, max_length=255)),
+                ('state', models.CharField(choices=[('active', 'active'), ('inactive', 'inactive')], default='active', max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='googlepaypasses', to='pretixbase.Event')),
+                ('position', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='googlepaypasses', to='pretixbase.OrderPosition')),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_googlepaypasses', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlepaypass',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_googlepaypasses', '0002_googlepaypass_last_seen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlepaypass',
+            name='payload_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='googlepaypass',
+            name='last_synced',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='googlepaypass',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='googlepaypass',
+            index=models.Index(fields=['position', 'state'], name='googlepaypass_position_state'),
+        ),
+        migrations.AddIndex(
+            model_name='googlepaypass',
+            index=models.Index(fields=['event', 'state'], name='googlepaypass_event_state'),
+        ),
+        migrations.AddIndex(
+            model_name='googlepaypass',
+            index=models.Index(fields=['class_id', 'state'], name='googlepaypass_class_state'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0001_initial'),
+        ('pretix_googlepaypasses', '0003_pass_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=190, unique=True)),
+                ('operation', models.CharField(choices=[('shred_object', 'shred_object'), ('shred_order', 'shred_order'), ('refresh_order', 'refresh_order'), ('refresh_class', 'refresh_class')], max_length=32)),
+                ('target_id', models.BigIntegerField()),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='googlepaypasses_outbox', to='pretixbase.Event')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxentry',
+            index=models.Index(fields=['state', 'next_attempt'], name='googlepaypass_outbox_due'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_googlepaypasses', '0004_outboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlepaypass',
+            name='unused_checked',
+            field=models.BooleanField(default=False),
+        ),
+    ]
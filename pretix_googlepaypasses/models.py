@@ -0,0 +1,68 @@
+from django.db import models
+
+
+class GooglePayPass(models.Model):
+    STATE_ACTIVE = 'active'
+    STATE_INACTIVE = 'inactive'
+    STATE_CHOICES = (
+        (STATE_ACTIVE, STATE_ACTIVE),
+        (STATE_INACTIVE, STATE_INACTIVE),
+    )
+
+    object_id = models.CharField(max_length=255, unique=True)
+    class_id = models.CharField(max_length=255, db_index=True)
+    position = models.ForeignKey('pretixbase.OrderPosition', on_delete=models.CASCADE, related_name='googlepaypasses')
+    event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='googlepaypasses')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_ACTIVE)
+    payload_hash = models.CharField(max_length=64, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    last_seen = models.DateTimeField(null=True, blank=True)
+    last_synced = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    # Set once shred_unused has listed the pass's class completely after its event had ended
+    unused_checked = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['position', 'state'], name='googlepaypass_position_state'),
+            models.Index(fields=['event', 'state'], name='googlepaypass_event_state'),
+            models.Index(fields=['class_id', 'state'], name='googlepaypass_class_state'),
+        ]
+
+
+class OutboxEntry(models.Model):
+    OP_SHRED_OBJECT = 'shred_object'
+    OP_SHRED_ORDER = 'shred_order'
+    OP_REFRESH_ORDER = 'refresh_order'
+    OP_REFRESH_CLASS = 'refresh_class'
+    OP_CHOICES = (
+        (OP_SHRED_OBJECT, OP_SHRED_OBJECT),
+        (OP_SHRED_ORDER, OP_SHRED_ORDER),
+        (OP_REFRESH_ORDER, OP_REFRESH_ORDER),
+        (OP_REFRESH_CLASS, OP_REFRESH_CLASS),
+    )
+    STATE_PENDING = 'pending'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = (
+        (STATE_PENDING, STATE_PENDING),
+        (STATE_FAILED, STATE_FAILED),
+    )
+
+    # operation:target_id - there is at most one entry per target and operation, further changes are coalesced into it
+    key = models.CharField(max_length=190, unique=True)
+    operation = models.CharField(max_length=32, choices=OP_CHOICES)
+    target_id = models.BigIntegerField()
+    event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='googlepaypasses_outbox')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_PENDING)
+    version = models.PositiveIntegerField(default=1)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'next_attempt'], name='googlepaypass_outbox_due'),
+        ]
@@ -0,0 +1,199 @@
+import logging
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils.timezone import now
+from pretix_googlepaypasses.comms import ApiError
+from pretix_googlepaypasses.metrics import (
+    record_debounce, record_outbox_operations,
+)
+from pretix_googlepaypasses.models import OutboxEntry
+from pretix_googlepaypasses.ratelimit import RetryableError
+
+logger = logging.getLogger(__name__)
+
+KICK_KEY = 'googlepaypasses_outbox_kick'
+KICK_TIMEOUT = 60
+DRAIN_BATCH_SIZE = 100
+DRAIN_MAX_SECONDS = 60
+# Claimed entries are leased by moving their next attempt into the future. Should the worker die while processing
+# them, they are picked up again once the lease has run out.
+LEASE = timedelta(minutes=10)
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+# With the backoff capped at an hour, this keeps an entry around for about two days of outage
+MAX_ATTEMPTS = 50
+
+
+def _key(operation: str, target_id):
+    return '%s:%s' % (operation, target_id)
+
+
+def enqueue(operation: str, target_id, event_id, delay: int = 0):
+    # Meant to be called within the transaction of the triggering change, so the entry is committed together with the
+    # change - or not at all. Another trigger for the same target pushes the due time back and bumps the version, so
+    # a worker that is processing the entry right now knows that it has to be processed once more.
+    key = _key(operation, target_id)
+    values = {
+        'version': F('version') + 1,
+        'state': OutboxEntry.STATE_PENDING,
+        'next_attempt': now() + timedelta(seconds=delay),
+        'updated': now(),
+    }
+
+    if operation == OutboxEntry.OP_SHRED_ORDER:
+        # The order's objects are shredded anyway, there is no point in refreshing them first
+        OutboxEntry.objects.filter(key=_key(OutboxEntry.OP_REFRESH_ORDER, target_id)).delete()
+
+    # Reported along with the debounced tasks, since coalescing triggers into an existing entry is what debounces them
+    record_debounce(operation, 'triggered')
+    coalesced = bool(OutboxEntry.objects.filter(key=key).update(**values))
+    if not coalesced:
+        try:
+            with transaction.atomic():
+                OutboxEntry.objects.create(key=key, operation=operation, target_id=target_id, event_id=event_id,
+                                           next_attempt=values['next_attempt'])
+        except IntegrityError:
+            coalesced = bool(OutboxEntry.objects.filter(key=key).update(**values))
+    if coalesced:
+        record_debounce(operation, 'coalesced')
+
+    transaction.on_commit(lambda: kick(delay))
+
+
+def kick(countdown: int = 0):
+    # Only wakes up a worker - if the message gets lost, the periodic task drains the outbox anyway. The key holds the
+    # time of the scheduled wake-up, so a kick is only skipped if a drain is due no later than it - one entry backing
+    # off for an hour must not hold up the entries added in the meantime.
+    from pretix_googlepaypasses.tasks import drain_outbox
+
+    wake_up = time.time() + countdown
+    if not cache.add(KICK_KEY, wake_up, countdown + KICK_TIMEOUT):
+        scheduled = cache.get(KICK_KEY)
+        if scheduled is not None and scheduled <= wake_up:
+            return
+        cache.set(KICK_KEY, wake_up, countdown + KICK_TIMEOUT)
+
+    drain_outbox.apply_async(countdown=countdown)
+
+
+def drain(max_seconds: int = DRAIN_MAX_SECONDS, batch_size: int = DRAIN_BATCH_SIZE):
+    # Entries that are added while draining need a new kick
+    cache.delete(KICK_KEY)
+    start = time.monotonic()
+    stats = Counter()
+
+    while True:
+        if time.monotonic() - start >= max_seconds:
+            kick()
+            break
+
+        entries = _claim(batch_size)
+        if not entries:
+            # Entries that got re-triggered or backed off are not due yet - wake up again once the first of them is
+            _schedule_next()
+            break
+
+        _process(entries, stats)
+
+    if stats:
+        logger.info('Google Pay Passes outbox: %s', dict(stats))
+    return stats
+
+
+def _schedule_next():
+    next_attempt = OutboxEntry.objects.filter(
+        state=OutboxEntry.STATE_PENDING
+    ).order_by('next_attempt').values_list('next_attempt', flat=True).first()
+    if next_attempt:
+        kick(max(0, int((next_attempt - now()).total_seconds()) + 1))
+
+
+def _claim(batch_size: int):
+    with transaction.atomic():
+        qs = OutboxEntry.objects.filter(
+            state=OutboxEntry.STATE_PENDING, next_attempt__lte=now()
+        ).order_by('next_attempt')
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+
+        entries = list(qs[:batch_size])
+        OutboxEntry.objects.filter(pk__in=[e.pk for e in entries]).update(next_attempt=now() + LEASE)
+
+    return entries
+
+
+def _process(entries: list, stats: Counter):
+    from pretix_googlepaypasses.tasks import OUTBOX_HANDLERS
+
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry.operation, []).append(entry)
+
+    for operation, group in groups.items():
+        error = 'Could not %s' % operation.replace('_', ' ')
+        try:
+            done = OUTBOX_HANDLERS[operation]([entry.target_id for entry in group])
+        except (ApiError, RetryableError) as e:
+            done, error = set(), str(e)
+        except Exception as e:
+            # One broken operation must not hold up the others
+            logger.exception('Processing %s from the Google Pay Passes outbox failed.', operation)
+            done, error = set(), repr(e)
+
+        succeeded = [entry for entry in group if entry.target_id in done]
+        failed = [entry for entry in group if entry.target_id not in done]
+
+        if succeeded:
+            # Entries that have been triggered again in the meantime stay, with the due time of the new trigger
+            OutboxEntry.objects.filter(reduce(or_, [Q(pk=e.pk, version=e.version) for e in succeeded])).delete()
+        for entry in failed:
+            _record_failure(entry, error)
+
+        stats['%s_done' % operation] += len(succeeded)
+        stats['%s_failed' % operation] += len(failed)
+        record_outbox_operations(operation, len(succeeded), len(failed))
+
+
+def _record_failure(entry: OutboxEntry, error: str):
+    attempts = entry.attempts + 1
+    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** entry.attempts) * random.uniform(0.5, 1)
+
+    OutboxEntry.objects.filter(pk=entry.pk).update(
+        attempts=attempts,
+        state=OutboxEntry.STATE_FAILED if attempts >= MAX_ATTEMPTS else OutboxEntry.STATE_PENDING,
+        next_attempt=now() + timedelta(seconds=backoff),
+        last_error=error,
+        updated=now(),
+    )
+
+    if attempts >= MAX_ATTEMPTS:
+        logger.error('Giving up on %s after %d attempts: %s', entry.key, attempts, error)
+
+
+def retry_failed():
+    return OutboxEntry.objects.filter(state=OutboxEntry.STATE_FAILED).update(
+        state=OutboxEntry.STATE_PENDING, attempts=0, next_attempt=now(), updated=now()
+    )
+
+
+def get_outbox_stats():
+    current = now()
+    stats = list(OutboxEntry.objects.order_by('operation', 'state').values('operation', 'state').annotate(
+        depth=Count('id'),
+        due=Count('id', filter=Q(next_attempt__lte=current)),
+        oldest=Min('created'),
+        max_attempts=Max('attempts'),
+    ))
+
+    for row in stats:
+        row['oldest_age'] = (current - row.pop('oldest')).total_seconds()
+
+    return stats
@@ -0,0 +1,96 @@
+import threading
+import time
+from contextlib import ContextDecorator
+
+from django.core.cache import cache
+from pretix_googlepaypasses.config import get_config
+from pretix_googlepaypasses.metrics import record_ratelimit_wait
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BACKGROUND = 'background'
+
+# Share of each second's budget that background work may not touch, so downloads are never starved by refreshes
+INTERACTIVE_RESERVE = 0.25
+BACKGROUND_MAX_WAIT = 10
+INTERACTIVE_MAX_WAIT = 1
+
+_local = threading.local()
+
+
+class RetryableError(Exception):
+    pass
+
+
+class background_lane(ContextDecorator):
+    # The lanes are kept as a per-thread stack, since the same decorator instance is shared by all calls of a task.
+    def __enter__(self):
+        if not hasattr(_local, 'lanes'):
+            _local.lanes = []
+        _local.lanes.append(LANE_BACKGROUND)
+        return self
+
+    def __exit__(self, *exc):
+        _local.lanes.pop()
+        return False
+
+
+def get_lane():
+    lanes = getattr(_local, 'lanes', None)
+    return lanes[-1] if lanes else LANE_INTERACTIVE
+
+
+def get_requests_per_second():
+    return get_config('requests_per_second', 20)
+
+
+def acquire(bucket: str, tokens: int = 1):
+    # Fixed one-second windows counted with cache.incr, which is atomic on the shared cache backends, so the budget
+    # holds across all worker processes. Background calls only get the part of the budget not reserved for
+    # interactive ones and wait longer before giving up.
+    limit = get_requests_per_second()
+    lane = get_lane()
+    if lane == LANE_BACKGROUND:
+        limit = max(1, int(limit * (1 - INTERACTIVE_RESERVE)))
+
+    # A window can never hold more than the limit, so larger requests (batches) are spread over several windows
+    while tokens > limit:
+        if not _acquire_window(bucket, limit, limit, lane):
+            return False
+        tokens -= limit
+
+    return _acquire_window(bucket, tokens, limit, lane)
+
+
+def _acquire_window(bucket: str, tokens: int, limit: int, lane: str):
+    started = time.time()
+    deadline = started + (BACKGROUND_MAX_WAIT if lane == LANE_BACKGROUND else INTERACTIVE_MAX_WAIT)
+
+    while True:
+        now = time.time()
+        key = 'googlepaypasses_ratelimit_%s_%d' % (bucket, int(now))
+        cache.add(key, 0, 5)
+        try:
+            used = cache.incr(key, tokens)
+        except ValueError:
+            used = tokens
+            cache.set(key, used, 5)
+
+        if used <= limit:
+            if now > started:
+                record_ratelimit_wait(lane, now - started)
+            return True
+
+        # Tokens that were not granted must not eat into the budget of the other callers
+        try:
+            cache.decr(key, tokens)
+        except ValueError:
+            pass
+
+        if now >= deadline:
+            record_ratelimit_wait(lane, now - started)
+            if lane == LANE_BACKGROUND:
+                raise RetryableError('Rate limit for %s exhausted' % bucket)
+            # Interactive calls rather risk a 429 than keep a customer waiting any longer
+            return False
+
+        time.sleep(int(now) + 1 - now)
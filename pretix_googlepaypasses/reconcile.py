@@ -0,0 +1,256 @@
+import json
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings as django_settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from pretix.base.models import Event, Order
+from pretix.base.settings import GlobalSettingsObject
+from pretix_googlepaypasses.comms import (
+    BATCH_SIZE, ApiError, get_comms, is_success,
+)
+from pretix_googlepaypasses.helpers import BACKFILL_DONE_KEY, deactivate_passes
+from pretix_googlepaypasses.models import GooglePayPass
+from walletobjects import EventTicketObject
+from walletobjects.constants import ObjectState, ObjectType
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_KEY = 'googlepaypasses_reconcile_checkpoint'
+UNUSED_CURSOR_KEY = 'googlepaypasses_shred_unused_cursor'
+# hasUsers is known to lag behind (or plainly be wrong) for freshly saved passes, so young passes are never touched
+UNUSED_MIN_AGE = timedelta(days=7)
+SWEEP_CHUNK_SIZE = 500
+# Objects handed out as fat JWTs are only uploaded in the background, so they are not reported as missing right away
+MISSING_GRACE_PERIOD = timedelta(hours=1)
+
+
+def reconcile(repair=False, max_pages=None, restart=False, min_interval=None, page_size=100):
+    # Walks the classes we know of in sorted order and streams each class's objects page by page. Every page is
+    # compared against the indexed GooglePayPass table and stamps the local rows it has seen. Once a class has been
+    # listed completely, the rows that were not stamped are the ones missing at Google. Memory use is bounded by one
+    # page, and the position within the run is checkpointed after every page, so a run can be split into slices.
+    gs = GlobalSettingsObject()
+    state = {} if restart else json.loads(gs.settings.get(CHECKPOINT_KEY) or '{}')
+    stats = Counter()
+    pages = 0
+
+    # Passes that are still only recorded in OrderPosition.meta_info look orphaned, but are in use on phones
+    repair_orphans = repair and bool(gs.settings.get(BACKFILL_DONE_KEY))
+    if repair and not repair_orphans:
+        logger.warning('Not deactivating orphaned Google Pay Passes - googlepaypasses_backfill has not been run yet.')
+
+    if state.get('completed'):
+        if min_interval and parse_datetime(state['completed']) > now() - min_interval:
+            return stats
+        state = {}
+
+    while not max_pages or pages < max_pages:
+        if not state.get('class_id') or state.get('class_done'):
+            class_id = GooglePayPass.objects.filter(
+                class_id__gt=state.get('class_id', '')
+            ).order_by('class_id').values_list('class_id', flat=True).first()
+
+            if class_id is None:
+                state = {'completed': now().isoformat()}
+                stats['completed'] = 1
+                break
+
+            state = {'class_id': class_id, 'started': now().isoformat(), 'token': None, 'class_done': False}
+
+        started = parse_datetime(state['started'])
+        event = GooglePayPass.objects.filter(class_id=state['class_id']).select_related('event').first().event
+        comms = get_comms(event.settings.get('googlepaypasses_credentials'))
+
+        result = comms.list_items(ObjectType.eventTicketObject, class_id=state['class_id'], token=state['token'],
+                                  max_results=page_size)
+        if result is None:
+            gs.settings.set(CHECKPOINT_KEY, json.dumps(state))
+            raise ApiError('Could not list the objects of class %s' % state['class_id'])
+
+        _reconcile_page(comms, result.get('resources', []), started, repair, repair_orphans, stats)
+        pages += 1
+        stats['pages'] += 1
+
+        state['token'] = result.get('pagination', {}).get('nextPageToken')
+        if not state['token']:
+            _sweep_missing(state['class_id'], started, repair, stats)
+            state['class_done'] = True
+            stats['classes'] += 1
+
+        gs.settings.set(CHECKPOINT_KEY, json.dumps(state))
+
+    gs.settings.set(CHECKPOINT_KEY, json.dumps(state))
+    logger.info('Google Pay Passes reconciliation: %s', dict(stats))
+    return stats
+
+
+def _is_canceled(googlepaypass: GooglePayPass):
+    position = googlepaypass.position
+    return getattr(position, 'canceled', False) or position.order.status == Order.STATUS_CANCELED
+
+
+def _class_locales(class_ids):
+    # Objects are written in the locale of their event. Orphans have no pass of their own, but their class is known.
+    event_ids = dict(
+        GooglePayPass.objects.filter(class_id__in=set(class_ids)).values_list('class_id', 'event_id').distinct()
+    )
+    events = {event.pk: event for event in Event.objects.filter(pk__in=set(event_ids.values()))}
+    return {
+        class_id: events[event_id].settings.locale if event_id in events else django_settings.LANGUAGE_CODE
+        for class_id, event_id in event_ids.items()
+    }
+
+
+def _reconcile_page(comms, resources: list, started, repair: bool, repair_orphans: bool, stats: Counter):
+    object_ids = [resource['id'] for resource in resources]
+    local = {
+        p.object_id: p
+        for p in GooglePayPass.objects.filter(object_id__in=object_ids).select_related('position', 'position__order')
+    }
+    GooglePayPass.objects.filter(object_id__in=object_ids).update(last_seen=started)
+
+    to_deactivate = []
+    for resource in resources:
+        stats['remote'] += 1
+        remote_active = resource.get('state', '').lower() == 'active'
+        googlepaypass = local.get(resource['id'])
+
+        if googlepaypass is None:
+            stats['orphaned'] += 1
+            logger.info('Google Pay Pass %s is not known locally', resource['id'])
+            if remote_active and repair_orphans:
+                to_deactivate.append(resource)
+        elif remote_active and (googlepaypass.state == GooglePayPass.STATE_INACTIVE or _is_canceled(googlepaypass)):
+            stats['active_but_inactive_locally'] += 1
+            logger.info('Google Pay Pass %s is still active but its position is not', resource['id'])
+            to_deactivate.append(resource)
+        else:
+            stats['in_sync'] += 1
+
+    if repair and to_deactivate:
+        locales = _class_locales(r['classId'] for r in to_deactivate)
+        statuses = comms.batch_put_items('eventTicketObject', [
+            (r['id'], EventTicketObject(r['id'], r['classId'], ObjectState.inactive,
+                                        locales.get(r['classId'], django_settings.LANGUAGE_CODE)))
+            for r in to_deactivate
+        ])
+        deactivated = [object_id for object_id, status in statuses.items() if is_success(status)]
+        deactivate_passes(deactivated)
+        stats['deactivated'] += len(deactivated)
+
+
+def _sweep_missing(class_id: str, started, repair: bool, stats: Counter):
+    last_object_id = ''
+
+    while True:
+        chunk = list(
+            GooglePayPass.objects.filter(
+                Q(last_seen__isnull=True) | Q(last_seen__lt=started),
+                class_id=class_id,
+                state=GooglePayPass.STATE_ACTIVE,
+                created__lt=started - MISSING_GRACE_PERIOD,
+                object_id__gt=last_object_id,
+            ).order_by('object_id')[:SWEEP_CHUNK_SIZE]
+        )
+
+        if not chunk:
+            return
+
+        for googlepaypass in chunk:
+            stats['missing_remotely'] += 1
+            logger.info('Google Pay Pass %s is recorded locally but does not exist at Google', googlepaypass.object_id)
+
+        if repair:
+            # Deactivating the record means the next download creates a new object
+            deactivate_passes([p.object_id for p in chunk])
+            stats['forgotten'] += len(chunk)
+
+        last_object_id = chunk[-1].object_id
+
+
+def shred_unused(max_pages=5, max_seconds=30, page_size=100):
+    # Deactivates passes that nobody has saved to a device, a few class listing pages per call. The cursor is kept
+    # in the global settings. The passes of events that had already ended when their class's last full listing
+    # started are marked, so their classes are not visited again unless new passes show up.
+    start = time.monotonic()
+    gs = GlobalSettingsObject()
+    state = json.loads(gs.settings.get(UNUSED_CURSOR_KEY) or '{}')
+    # Left behind by earlier versions, which kept a list of finished classes instead
+    state.pop('done', None)
+    stats = Counter()
+    wrapped = False
+
+    while stats['pages'] < max_pages and time.monotonic() - start < max_seconds:
+        if not state.get('class_id'):
+            class_id = GooglePayPass.objects.filter(
+                class_id__gt=state.get('last_class_id', ''), state=GooglePayPass.STATE_ACTIVE, unused_checked=False
+            ).order_by('class_id').values_list('class_id', flat=True).first()
+
+            if class_id is None:
+                if wrapped or not state.get('last_class_id'):
+                    break
+                state['last_class_id'] = ''
+                wrapped = True
+                continue
+
+            state.update({'class_id': class_id, 'token': None, 'started': now().isoformat()})
+
+        event = GooglePayPass.objects.filter(class_id=state['class_id']).select_related('event').first().event
+        comms = get_comms(event.settings.get('googlepaypasses_credentials'))
+
+        result = comms.list_items(ObjectType.eventTicketObject, class_id=state['class_id'], token=state['token'],
+                                  max_results=page_size)
+        stats['api_calls'] += 1
+        if result is None:
+            break
+
+        _shred_unused_page(comms, result.get('resources', []), stats)
+        stats['pages'] += 1
+
+        state['token'] = result.get('pagination', {}).get('nextPageToken')
+        if not state['token']:
+            started = parse_datetime(state['started'])
+            if (event.date_to or event.date_from) < started:
+                # Passes that were too young to be shredded during this listing keep the class on the list
+                GooglePayPass.objects.filter(class_id=state['class_id'], created__lt=started - UNUSED_MIN_AGE).update(
+                    unused_checked=True
+                )
+            state['last_class_id'] = state['class_id']
+            state['class_id'] = None
+
+        gs.settings.set(UNUSED_CURSOR_KEY, json.dumps(state))
+
+    logger.info('Shredding unused Google Pay Passes took %.2fs, %d API calls, %d pages, %d passes shredded',
+                time.monotonic() - start, stats['api_calls'], stats['pages'], stats['shredded'])
+    return stats
+
+
+def _shred_unused_page(comms, resources: list, stats: Counter):
+    unused = {
+        r['id']: r for r in resources
+        if r.get('state', '').lower() == 'active' and r.get('hasUsers') is False
+    }
+    if not unused:
+        return
+
+    candidates = list(GooglePayPass.objects.filter(
+        object_id__in=list(unused), state=GooglePayPass.STATE_ACTIVE, created__lt=now() - UNUSED_MIN_AGE,
+    ).select_related('event'))
+    if not candidates:
+        return
+
+    statuses = comms.batch_put_items('eventTicketObject', [
+        (p.object_id, EventTicketObject(p.object_id, unused[p.object_id]['classId'], ObjectState.inactive,
+                                        p.event.settings.locale))
+        for p in candidates
+    ])
+    stats['api_calls'] += -(-len(candidates) // BATCH_SIZE)
+
+    shredded = [p for p in candidates if is_success(statuses.get(p.object_id, 0))]
+    deactivate_passes([p.object_id for p in shredded])
+    stats['shredded'] += len(shredded)
@@ -1,21 +1,36 @@
 import json
+import logging
 from collections import OrderedDict
 
+from celery.signals import worker_process_init
 from django import forms
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.template.loader import get_template
 from django.urls import resolve
 from django.utils.translation import ugettext_lazy as _, ugettext_noop
 from i18nfield.strings import LazyI18nString
-from pretix.base.models import Event, LogEntry, OrderPosition
-from pretix.base.settings import settings_hierarkey
+from pretix.base.models import GlobalSettingsObject_SettingsStore, LogEntry
+from pretix.base.settings import GlobalSettingsObject, settings_hierarkey
 from pretix.base.signals import (
-    periodic_task, register_global_settings, register_ticket_outputs,
+    order_paid, order_placed, periodic_task, register_global_settings,
+    register_ticket_outputs,
 )
 from pretix.presale.signals import html_head as html_head_presale
 from pretix_googlepaypasses import tasks
+from pretix_googlepaypasses.comms import evict_comms, get_comms
+from pretix_googlepaypasses.debounce import DEFAULT_WINDOW, debounce
 from pretix_googlepaypasses.forms import validate_json_credentials
+from pretix_googlepaypasses.helpers import (
+    get_config_flag, invalidate_all_id_prefixes, invalidate_class_cache,
+    invalidate_id_prefix,
+)
+from pretix_googlepaypasses.models import OutboxEntry
+from pretix_googlepaypasses.outbox import enqueue, kick
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(register_ticket_outputs, dispatch_uid='output_googlepaypasses')
@@ -57,64 +72,193 @@ def html_head_presale(sender, request=None, **kwargs):
         return ""
 
 
+PREPROVISION_BATCH_SIZE = 50
+
+
+def preprovision_order(order):
+    event = order.event
+    if not event.settings.get('ticketoutput_googlepaypasses__enabled', as_type=bool):
+        return
+    if not event.settings.get('ticketoutput_googlepaypasses_preprovision', as_type=bool):
+        return
+
+    # Only positions that can ever have a ticket - the same ones generate_order hands out
+    op_ids = [op.id for op in order.positions_with_tickets]
+
+    for i in range(0, len(op_ids), PREPROVISION_BATCH_SIZE):
+        batch = op_ids[i:i + PREPROVISION_BATCH_SIZE]
+        transaction.on_commit(
+            lambda batch=batch: tasks.preprovision_objects.apply_async(args=(event.id, batch))
+        )
+
+
+@receiver(order_paid, dispatch_uid="googlepaypasses_order_paid")
+def order_paid_preprovision(sender, order, **kwargs):
+    preprovision_order(order)
+
+
+@receiver(order_placed, dispatch_uid="googlepaypasses_order_placed")
+def order_placed_preprovision(sender, order, **kwargs):
+    # Paid orders are handled by order_paid - pending orders only have tickets if the event allows it
+    if order.status == order.STATUS_PENDING and sender.settings.get('ticket_download_pending', as_type=bool):
+        preprovision_order(order)
+
+
+SHRED_ACTIONS = frozenset((
+    'pretix.event.order.secret.changed', 'pretix.event.order.changed.secret', 'pretix.event.order.changed.cancel',
+    'pretix.event.order.changed.split',
+))
+REFRESH_ACTIONS = frozenset((
+    'pretix.event.order.changed.item', 'pretix.event.order.changed.price', 'pretix.event.order.changed.subevent',
+))
+EVENT_ACTIONS = frozenset((
+    'pretix.event.tickets.provider.googlepaypasses', 'pretix.event.changed', 'pretix.event.settings',
+))
+PLUGIN_ACTIONS = frozenset((
+    'pretix.event.plugins.enabled', 'pretix.event.plugins.disabled',
+))
+ORGANIZER_ACTIONS = frozenset((
+    'pretix.organizer.settings',
+))
+DISPATCHED_ACTIONS = SHRED_ACTIONS | REFRESH_ACTIONS | EVENT_ACTIONS | PLUGIN_ACTIONS | ORGANIZER_ACTIONS
+PLUGIN_ENABLED_CACHE_TIMEOUT = 300
+
+
+def _plugin_enabled_cache_key(event_id):
+    return 'googlepaypasses_plugin_enabled_%s' % event_id
+
+
+def is_plugin_enabled(logentry: LogEntry):
+    # log_action() hands the event to the log entry, so a cache miss usually does not need a query either
+    cache_key = _plugin_enabled_cache_key(logentry.event_id)
+    enabled = cache.get(cache_key)
+
+    if enabled is None:
+        enabled = 'pretix_googlepaypasses' in logentry.event.get_plugins()
+        cache.set(cache_key, enabled, PLUGIN_ENABLED_CACHE_TIMEOUT)
+
+    return enabled
+
+
+def _invalidate_event(event):
+    invalidate_id_prefix(event)
+    invalidate_class_cache(event)
+
+
 @receiver(post_save, sender=LogEntry, dispatch_uid="googlepaypasses_logentry_post_save")
 def logentry_post_save(sender, instance, **kwargs):
-    if instance.action_type in [
-        'pretix.event.order.secret.changed', 'pretix.event.order.changed.secret', 'pretix.event.order.changed.cancel',
-        'pretix.event.order.changed.split'
-    ]:
-        instance_data = json.loads(instance.data)
+    # Runs for every log entry of the installation, so anything that is not ours has to be dropped as cheaply as
+    # possible. Writes to Google go through the outbox, which is written within the transaction of the change, so the
+    # change and the work it causes are committed together. Everything else waits for the commit.
+    action_type = instance.action_type
+    if action_type not in DISPATCHED_ACTIONS:
+        return
+
+    if action_type in ORGANIZER_ACTIONS:
+        organizer_id = instance.object_id
+        transaction.on_commit(lambda: debounce('refresh_organizer_classes', organizer_id))
+        return
+
+    if not instance.event_id:
+        return
 
-        if 'position' and 'positionid' in instance_data:
+    if action_type in PLUGIN_ACTIONS:
+        cache.delete(_plugin_enabled_cache_key(instance.event_id))
+        return
+
+    if not is_plugin_enabled(instance):
+        return
+
+    if action_type in EVENT_ACTIONS:
+        event = instance.event
+        transaction.on_commit(lambda: _invalidate_event(event))
+        enqueue(OutboxEntry.OP_REFRESH_CLASS, event.pk, event.pk, delay=DEFAULT_WINDOW)
+        return
+
+    order_id = instance.object_id
+    data = json.loads(instance.data or '{}')
+
+    if action_type in SHRED_ACTIONS:
+        if 'position' in data and 'positionid' in data:
             # {"position": 4, "positionid": 1} --> changed OrderPosition
-            op = OrderPosition.objects.get(order=instance.object_id, id=instance_data['position'])
-            tasks.shred_object.apply_async(args=(op.id,))
+            enqueue(OutboxEntry.OP_SHRED_OBJECT, data['position'], instance.event_id)
         else:
             # {} --> whole changed Order
-            ops = OrderPosition.objects.filter(order=instance.object_id)
-            for op in ops:
-                tasks.shred_object.apply_async(args=(op.id,))
-    elif instance.action_type in ['pretix.event.order.changed.item', 'pretix.event.order.changed.price', 'pretix.event.order.changed.subevent']:
-        instance_data = json.loads(instance.data)
-        op = OrderPosition.objects.get(order=instance.object_id, id=instance_data['position'])
+            enqueue(OutboxEntry.OP_SHRED_ORDER, order_id, instance.event_id)
+    elif action_type in REFRESH_ACTIONS:
+        # Changing an order usually logs one entry per position - they all end up in one refresh of the order
+        enqueue(OutboxEntry.OP_REFRESH_ORDER, order_id, instance.event_id, delay=DEFAULT_WINDOW)
+
+
+@receiver(post_save, sender=GlobalSettingsObject_SettingsStore, dispatch_uid="googlepaypasses_global_settings_saved")
+@receiver(post_delete, sender=GlobalSettingsObject_SettingsStore, dispatch_uid="googlepaypasses_global_settings_deleted")
+def global_settings_changed(sender, instance, **kwargs):
+    # Clients and parsed credentials are keyed by the credentials' fingerprint, so nothing stale can be used anyway -
+    # this only frees the ones that are not needed anymore.
+    if instance.key == 'googlepaypasses_credentials':
+        evict_comms()
+    elif instance.key == 'googlepaypasses_issuer_id':
+        # The issuer id is part of every class and object id - Google rejects writes that still use the old one
+        invalidate_all_id_prefixes()
 
-        tasks.refresh_object.apply_async(args=(op.id,), countdown=5)
-    elif instance.action_type in ['pretix.event.tickets.provider.googlepaypasses', 'pretix.event.changed', 'pretix.event.settings']:
-        event = Event.objects.get(id=instance.event_id)
 
-        tasks.refresh_class.apply_async(args=(event.id,), countdown=5)
-    elif instance.action_type in ['pretix.organizer.settings']:
-        events = Event.objects.filter(organizer_id=instance.object_id, plugins__contains='pretix_googlepaypasses')
+@worker_process_init.connect
+def warm_comms(**kwargs):
+    # Parses the credentials and sets up the API client before the first task needs them
+    try:
+        credentials = GlobalSettingsObject().settings.get('googlepaypasses_credentials')
+        if credentials:
+            get_comms(credentials)
+    except Exception:
+        logger.exception('Could not set up the Google Pay Passes API client.')
 
-        for event in events:
-            tasks.refresh_class.apply_async(args=(event.id,), countdown=5)
 
+@receiver(signal=periodic_task, dispatch_uid="googlepaypasses_reconcile")
+def reconcile_passes(sender, **kwargs):
+    # One slice at a time - a slice that is still running keeps the next one from being enqueued
+    if cache.add('googlepaypasses_reconcile_running', True, 900):
+        tasks.reconcile_passes.apply_async()
 
-@receiver(signal=periodic_task)
+
+@receiver(signal=periodic_task, dispatch_uid="googlepaypasses_drain_outbox")
+def drain_outbox(sender, **kwargs):
+    # Picks up retries and anything whose kick got lost on the way to the broker
+    kick()
+
+
+@receiver(signal=periodic_task, dispatch_uid="googlepaypasses_shred_unused_objects")
 def shred_unused_objects(sender, **kwargs):
-    # Oh well...
     # Google does supposedly report if a WalletObject has any users...
     #
     # hasUsers - boolean - Indicates if the object has users. This field is set by the platform
     #
-    # Guess what: it doesn't work and reports "hasUsers -> False" even when the object is installed.
-    # Perhaps this is just a timing issue (Result is cached on the Google-side?) - but for now we cannot
-    # offer automatic shredding of unused passes. Sucks :-(
-
-    # ops = OrderPosition.objects.filter(meta_info__contains='"googlepaypass"')
-    # for op in ops:
-    #     comms = Comms(op.event.settings.get('googlepaypasses_credentials'))
-    #     meta_info = json.loads(op.meta_info or '{}')
-    #     object_id = meta_info['googlepaypass']
-    #
-    #     item = comms.get_item(ObjectType.eventTicketObject, object_id)
-    #
-    #     if item and not item['hasUsers']:
-    #         tasks.shred_object(op.pk)
+    # In practice it has been seen to report "hasUsers -> False" even when the object is installed - perhaps the
+    # result is cached on the Google-side. We therefore only look at passes that are at least a week old and leave
+    # it to the administrator to enable this with shred_unused in the [googlepaypasses] section of pretix.cfg.
+    if not get_config_flag('shred_unused'):
+        return
 
-    return
+    if cache.add('googlepaypasses_shred_unused_running', True, 900):
+        tasks.shred_unused_objects.apply_async()
 
 
+settings_hierarkey.add_default(
+    'ticketoutput_googlepaypasses_preprovision_disclaimer_text',
+    LazyI18nString.from_gettext(ugettext_noop(
+        "Please be aware, that contrary to other virtual wallets/passes (like Apple Wallet), Google Pay Passes are not "
+        "handled offline. Every pass that is created, has to be transmitted to Google Inc.\r\n"
+        "\r\n"
+        "To make the download faster, your pass - including some of your personal information, which is necessary to "
+        "provide you with your Google Pay Pass - has already been transmitted to Google Inc. when your order was "
+        "confirmed. By clicking the **Save to phone**-button below, the pass will be added to your Google account.\r\n"
+        "\r\n"
+        "Please be aware, that there is no way to delete the data, once it has been transmitted.\r\n"
+        "\r\n"
+        "However we will anonymize all passes that are not linked to a device on a regular, best effort basis. While "
+        "this will remove your personal information from the pass, we cannot guarantee that Google is not keeping a "
+        "history of the previous passes.")),
+    LazyI18nString
+)
 settings_hierarkey.add_default(
     'ticketoutput_googlepaypasses_disclaimer_text',
     LazyI18nString.from_gettext(ugettext_noop(
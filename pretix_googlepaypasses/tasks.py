@@ -1,65 +1,379 @@
 import json
+import logging
+from datetime import timedelta
 from json import JSONDecodeError
 
+from django.core.cache import cache
 from django_scopes import scopes_disabled
 from pretix.base.models import Event, OrderPosition
+from pretix.base.services.tasks import ProfiledTask
 from pretix.celery_app import app
+from pretix_googlepaypasses.breaker import get_retry_in, release_probe
+from pretix_googlepaypasses.comms import (
+    RETRYABLE_STATUS, ApiError, get_comms, is_success,
+)
+from pretix_googlepaypasses.debounce import claim
 from pretix_googlepaypasses.googlepaypasses import WalletobjectOutput
-from pretix_googlepaypasses.helpers import get_class_id
+from pretix_googlepaypasses.helpers import (
+    deactivate_passes, get_class_id, get_config_flag, get_passes,
+    invalidate_class_cache, invalidate_id_prefix, invalidate_save_urls,
+    record_error, record_synced,
+)
+from pretix_googlepaypasses.models import GooglePayPass, OutboxEntry
+from pretix_googlepaypasses.outbox import drain, enqueue
+from pretix_googlepaypasses.ratelimit import RetryableError, background_lane
 from walletobjects import EventTicketObject, utils
-from walletobjects.comms import Comms
-from walletobjects.constants import ClassType, ObjectState, ObjectType
+from walletobjects.constants import ClassType, ObjectState
 
+logger = logging.getLogger(__name__)
 
-@app.task
+RETRY_OPTIONS = {
+    'autoretry_for': (RetryableError,),
+    'retry_backoff': True,
+    'retry_backoff_max': 600,
+    'retry_jitter': True,
+    'max_retries': 8,
+}
+
+RECONCILE_PAGES_PER_SLICE = 20
+RECONCILE_INTERVAL = timedelta(hours=24)
+
+
+def _count_retryable(statuses: dict):
+    return len([object_id for object_id, status in statuses.items() if status in RETRYABLE_STATUS or status == 0])
+
+
+def _raise_for_retryable(retryable: int):
+    if retryable:
+        # Everything that did succeed has already been persisted, so a retry only touches the remaining objects.
+        raise RetryableError('%d writes need to be retried' % retryable)
+
+
+def _group_by_credentials(ops):
+    groups = {}
+    passes = get_passes(ops)
+    for op in ops:
+        if op.pk not in passes:
+            continue
+        groups.setdefault(op.order.event.settings.get('googlepaypasses_credentials'), []).append((op, passes[op.pk]))
+    return groups
+
+
+def _record_errors(statuses: dict, error: str):
+    failed = [object_id for object_id, status in statuses.items() if not is_success(status)]
+    if failed:
+        record_error(failed, error)
+
+
+def _shred_objects(op_ids):
+    # The default manager hides canceled positions - and those are the ones that are shredded most of the time
+    ops = list(OrderPosition.all.filter(id__in=op_ids).select_related('order', 'order__event'))
+    results = {}
+    retryable = 0
+
+    for credentials, entries in _group_by_credentials(ops).items():
+        invalidate_save_urls([googlepaypass.object_id for op, googlepaypass in entries])
+        items = []
+        for op, googlepaypass in entries:
+            items.append((
+                googlepaypass.object_id,
+                EventTicketObject(googlepaypass.object_id, googlepaypass.class_id, ObjectState.inactive,
+                                  op.order.event.settings.locale)
+            ))
+
+        statuses = get_comms(credentials).batch_put_items('eventTicketObject', items)
+
+        deactivate_passes([object_id for object_id, status in statuses.items() if is_success(status)])
+        _record_errors(statuses, 'Could not shred the object')
+
+        for op, googlepaypass in entries:
+            results[op.id] = is_success(statuses.get(googlepaypass.object_id, 0))
+
+        retryable += _count_retryable(statuses)
+
+    return results, retryable
+
+
+def _refresh_objects(op_ids):
+    ops = list(OrderPosition.objects.filter(id__in=op_ids).select_related(
+        'order', 'order__event', 'item', 'variation', 'addon_to', 'seat'
+    ))
+    results = {}
+    outputs = {}
+    retryable = 0
+
+    for credentials, entries in _group_by_credentials(ops).items():
+        items = []
+        hashes = {}
+        for op, googlepaypass in entries:
+            event = op.order.event
+            if event.pk not in outputs:
+                outputs[event.pk] = WalletobjectOutput(event)
+                if not outputs[event.pk]._get_class(event):
+                    outputs[event.pk] = None
+            if outputs[event.pk] is None:
+                results[op.id] = False
+                continue
+
+            output_object, payload, payload_hash = outputs[event.pk]._build_object(op, googlepaypass)
+            items.append((payload['id'], output_object))
+            hashes[googlepaypass.object_id] = payload_hash
+
+        statuses = get_comms(credentials).batch_put_items('eventTicketObject', items)
+
+        invalidate_save_urls(list(hashes))
+        for object_id, payload_hash in hashes.items():
+            if is_success(statuses.get(object_id, 0)):
+                record_synced(object_id, payload_hash)
+        _record_errors(statuses, 'Could not refresh the object')
+
+        for op, googlepaypass in entries:
+            if googlepaypass.object_id in hashes:
+                results[op.id] = is_success(statuses.get(googlepaypass.object_id, 0))
+
+        retryable += _count_retryable(statuses)
+
+    return results, retryable
+
+
+@app.task(base=ProfiledTask, **RETRY_OPTIONS)
 @scopes_disabled()
-def shred_object(op_id):
+@background_lane()
+def refresh_objects(op_ids):
+    results, retryable = _refresh_objects(op_ids)
+    _raise_for_retryable(retryable)
+    return results
+
+
+@app.task(base=ProfiledTask, **RETRY_OPTIONS)
+@scopes_disabled()
+@background_lane()
+def reconcile_object(op_id):
     op = OrderPosition.objects.get(id=op_id)
+    output = WalletobjectOutput(op.event)
 
-    meta_info = json.loads(op.meta_info or '{}')
+    if not output._get_class(op.event):
+        return False
 
-    if 'googlepaypass' not in meta_info:
-        return True
+    return bool(output._get_object(op))
 
-    object_id = meta_info['googlepaypass']
-    class_id = get_class_id(op.order.event)
-    output_class = EventTicketObject(object_id, class_id, ObjectState.inactive, op.order.event.settings.locale)
-    comms = Comms(op.event.settings.get('googlepaypasses_credentials'))
 
-    if comms.put_item(ClassType.eventTicketClass, class_id, output_class):
-        # Remove googlepaypass from OrderPostition meta_info once it has been shredded
-        meta_info.pop('googlepaypass')
-        op.meta_info = json.dumps(meta_info)
-        op.save(update_fields=['meta_info'])
-        return True
+@app.task(base=ProfiledTask, rate_limit='30/m', **RETRY_OPTIONS)
+@scopes_disabled()
+@background_lane()
+def preprovision_objects(event_id, op_ids):
+    event = Event.objects.get(id=event_id)
+    output = WalletobjectOutput(event)
 
+    if not output._get_class(event):
+        return 0
 
-@app.task
-def refresh_object(op_id):
-    op = OrderPosition.objects.get(id=op_id)
-    meta_info = json.loads(op.meta_info or '{}')
+    provisioned = 0
+    ops = OrderPosition.objects.filter(order__event=event, id__in=op_ids).select_related(
+        'order', 'item', 'variation', 'addon_to', 'seat'
+    )
+    for op in ops:
+        if output._get_object(op):
+            provisioned += 1
 
-    if 'googlepaypass' not in meta_info:
+    logger.info('Pre-provisioned %d of %d Google Pay Passes for event %s', provisioned, len(op_ids), event.slug)
+    return provisioned
+
+
+def _refresh_class(event: Event):
+    comms = get_comms(event.settings.get('googlepaypasses_credentials'))
+    existing = comms.get_item(ClassType.eventTicketClass, get_class_id(event))
+
+    if existing is None:
+        return False
+    elif existing is False:
+        # Nothing to refresh - the next download creates the class
         return True
 
-    object_id = meta_info['googlepaypass']
-    comms = Comms(op.event.settings.get('googlepaypasses_credentials'))
+    return bool(WalletobjectOutput(event)._generate_class(event))
 
-    if comms.get_item(ObjectType.eventTicketObject, object_id):
-        return WalletobjectOutput(op.event).generate(op)
 
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+def refresh_organizer_classes(organizer_id):
+    events = Event.objects.filter(organizer_id=organizer_id, plugins__contains='pretix_googlepaypasses')
 
-@app.task
-def refresh_class(event_id):
+    for event in events:
+        invalidate_id_prefix(event)
+        invalidate_class_cache(event)
+        enqueue(OutboxEntry.OP_REFRESH_CLASS, event.id, event.id)
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+@background_lane()
+def probe_api(event_id):
+    # Lets the circuit breaker of the event's issuer try a single cheap call once it has been open long enough
     event = Event.objects.get(id=event_id)
-    comms = Comms(event.settings.get('googlepaypasses_credentials'))
-    class_id = get_class_id(event)
+    issuer = event.settings.get('googlepaypasses_issuer_id')
+
+    retry_in = get_retry_in(issuer)
+    if retry_in:
+        probe_api.apply_async(args=(event_id,), countdown=retry_in)
+        return
+
+    try:
+        get_comms(event.settings.get('googlepaypasses_credentials')).get_item(
+            ClassType.eventTicketClass, get_class_id(event)
+        )
+    except RetryableError:
+        # Either the probe failed and the breaker is open again, or another call is probing already
+        pass
+    finally:
+        release_probe(issuer)
 
-    if comms.get_item(ClassType.eventTicketClass, class_id):
-        return WalletobjectOutput(event)._generate_class(event)
 
+def _group_by_order(rows):
+    positions = {}
+    for order_id, op_id in rows:
+        positions.setdefault(order_id, []).append(op_id)
+    return positions
 
-@app.task
+
+def _done_orders(order_ids, positions: dict, results: dict):
+    # Positions without a result had no active pass, so there was nothing to do for them
+    return {
+        order_id for order_id in order_ids
+        if all(results.get(op_id, True) for op_id in positions.get(order_id, []))
+    }
+
+
+def _shredded(op_ids):
+    # A position is only done once it is known to exist and has no active pass left - one that cannot be found
+    # must not count as shredded, its object might still be active at Google
+    existing = set(OrderPosition.all.filter(id__in=op_ids).values_list('id', flat=True))
+    active = set(GooglePayPass.objects.filter(
+        position_id__in=op_ids, state=GooglePayPass.STATE_ACTIVE
+    ).values_list('position_id', flat=True))
+    return existing - active
+
+
+def _handle_shred_objects(op_ids):
+    _shred_objects(op_ids)
+    return _shredded(op_ids)
+
+
+def _handle_shred_orders(order_ids):
+    positions = _group_by_order(OrderPosition.all.filter(
+        order_id__in=order_ids
+    ).values_list('order_id', 'id'))
+    op_ids = [op_id for op_ids in positions.values() for op_id in op_ids]
+    _shred_objects(op_ids)
+    shredded = _shredded(op_ids)
+    return {order_id for order_id in order_ids if all(op_id in shredded for op_id in positions.get(order_id, []))}
+
+
+def _handle_refresh_orders(order_ids):
+    positions = _group_by_order(GooglePayPass.objects.filter(
+        position__order_id__in=order_ids, state=GooglePayPass.STATE_ACTIVE
+    ).values_list('position__order_id', 'position_id'))
+    results, retryable = _refresh_objects([op_id for op_ids in positions.values() for op_id in op_ids])
+    return _done_orders(order_ids, positions, results)
+
+
+def _handle_refresh_classes(event_ids):
+    return {event.id for event in Event.objects.filter(id__in=event_ids) if _refresh_class(event)}
+
+
+# Each handler takes the target ids of a batch of outbox entries and returns the ids that are done
+OUTBOX_HANDLERS = {
+    OutboxEntry.OP_SHRED_OBJECT: _handle_shred_objects,
+    OutboxEntry.OP_SHRED_ORDER: _handle_shred_orders,
+    OutboxEntry.OP_REFRESH_ORDER: _handle_refresh_orders,
+    OutboxEntry.OP_REFRESH_CLASS: _handle_refresh_classes,
+}
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+@background_lane()
+def drain_outbox():
+    # Failed entries are retried by the outbox itself, with their own backoff
+    drain()
+
+
+# The tasks earlier versions sent instead of writing to the outbox. Messages that were still queued during an upgrade
+# are handed over to the outbox, so their shreds and refreshes are not lost.
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+def shred_object(op_id):
+    op = OrderPosition.all.filter(id=op_id).select_related('order').first()
+    if op:
+        enqueue(OutboxEntry.OP_SHRED_OBJECT, op.id, op.order.event_id)
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+def refresh_object(op_id):
+    op = OrderPosition.all.filter(id=op_id).select_related('order').first()
+    if op:
+        enqueue(OutboxEntry.OP_REFRESH_ORDER, op.order_id, op.order.event_id)
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+def refresh_class(event_id):
+    if Event.objects.filter(id=event_id).exists():
+        enqueue(OutboxEntry.OP_REFRESH_CLASS, event_id, event_id)
+
+
+DEBOUNCED_TASKS = {
+    'refresh_organizer_classes': refresh_organizer_classes,
+}
+
+
+@app.task(base=ProfiledTask, **RETRY_OPTIONS)
+@scopes_disabled()
+@background_lane()
+def run_debounced(name, target_id):
+    remaining = claim(name, target_id)
+
+    if remaining:
+        run_debounced.apply_async(args=(name, target_id), countdown=remaining)
+        return
+
+    return DEBOUNCED_TASKS[name](target_id)
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+@background_lane()
+def reconcile_passes():
+    from pretix_googlepaypasses.reconcile import reconcile
+
+    try:
+        reconcile(
+            repair=get_config_flag('reconcile_repair'),
+            max_pages=RECONCILE_PAGES_PER_SLICE,
+            min_interval=RECONCILE_INTERVAL,
+        )
+    except (ApiError, RetryableError):
+        # The checkpoint is kept, the next slice continues where this one failed
+        logger.exception('Google Pay Passes reconciliation slice failed.')
+    finally:
+        cache.delete('googlepaypasses_reconcile_running')
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+@background_lane()
+def shred_unused_objects():
+    from pretix_googlepaypasses.reconcile import shred_unused
+
+    try:
+        shred_unused()
+    except (ApiError, RetryableError):
+        logger.exception('Shredding unused Google Pay Passes failed.')
+    finally:
+        cache.delete('googlepaypasses_shred_unused_running')
+
+
+@app.task(base=ProfiledTask)
 @scopes_disabled()
 def process_webhook(webhook_body, issuer_id):
     try:
@@ -69,16 +383,23 @@ def process_webhook(webhook_body, issuer_id):
 
     webhook_json = utils.unseal_callback(webhook_json, issuer_id)
 
-    if 'objectId' and 'eventType' in webhook_json:
-        if webhook_json['eventType'] == 'del':
-            op = OrderPosition.objects.filter(
-                meta_info__contains='"googlepaypass": "{}"'.format(webhook_json['objectId'])
+    return process_webhook_message(webhook_json)
+
+
+@app.task(base=ProfiledTask)
+@scopes_disabled()
+def process_webhook_message(message):
+    # The message's signature has already been verified at this point.
+    if 'objectId' in message and 'eventType' in message:
+        if message['eventType'] == 'del':
+            googlepaypass = GooglePayPass.objects.filter(
+                object_id=message['objectId'], state=GooglePayPass.STATE_ACTIVE
             ).first()
 
-            if op:
-                shred_object.apply_async(args=(op.id,))
+            if googlepaypass:
+                enqueue(OutboxEntry.OP_SHRED_OBJECT, googlepaypass.position_id, googlepaypass.event_id)
 
-        elif webhook_json['eventType'] == 'save':
+        elif message['eventType'] == 'save':
             pass
 
         return True
@@ -1,6 +1,12 @@
 from django.conf.urls import url
-from pretix_googlepaypasses.views import webhook
+from pretix_googlepaypasses.views import OrderSaveLinks, image, webhook
 
 urlpatterns = [
     url(r'^_googlepaypasses/webhook/(?P<organizer>[^/]+)/$', webhook, name='webhook'),
+    url(r'^_googlepaypasses/image/(?P<organizer>[^/]+)/(?P<event>[^/]+)/(?P<kind>logo|hero)/(?P<image_hash>[0-9a-f]+)\.png$',
+        image, name='image'),
+]
+
+event_patterns = [
+    url(r'^googlepaypasses/order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/$', OrderSaveLinks.as_view(), name='order'),
 ]
@@ -2,14 +2,26 @@ import json
 import logging
 from json import JSONDecodeError
 
+from django.core.files.storage import default_storage
 from django.http import (
-    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    HttpResponseNotFound, HttpResponseNotModified,
 )
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
-from pretix.base.models import Organizer
+from django.views.decorators.http import require_GET, require_POST
+from django.views.generic import TemplateView
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Order
+from requests import RequestException
 
 from . import tasks
+from .callbacks import (
+    CallbackVerificationError, get_organizer_issuer_id, is_duplicate,
+    verify_callback,
+)
+from .googlepaypasses import SAVE_URL, WalletobjectOutput
+from .helpers import get_image_hash, get_image_name
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +31,7 @@ logger = logging.getLogger(__name__)
 def webhook(request, *args, **kwargs):
     # Google is not actually sending their documented UA m(
     # if request.META['HTTP_USER_AGENT'] != 'Google-Valuables':
-    if request.META['HTTP_USER_AGENT'] != "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)":
+    if request.META.get('HTTP_USER_AGENT') != "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)":
         return HttpResponseForbidden()
 
     if request.META.get('CONTENT_TYPE') != 'application/json':
@@ -27,16 +39,76 @@ def webhook(request, *args, **kwargs):
 
     try:
         webhook_json = json.loads(request.body.decode('utf-8'))
-    except JSONDecodeError:
-        return False
+    except (JSONDecodeError, UnicodeDecodeError):
+        return HttpResponseBadRequest()
+
+    if not isinstance(webhook_json, dict) or not all(
+            k in webhook_json for k in ('signature', 'intermediateSigningKey', 'protocolVersion', 'signedMessage')):
+        return HttpResponseBadRequest()
+
+    issuer_id = get_organizer_issuer_id(request.resolver_match.kwargs['organizer'])
+    if not issuer_id:
+        return HttpResponseNotFound()
 
-    if all(k in webhook_json for k in ('signature', 'intermediateSigningKey', 'protocolVersion', 'signedMessage')):
-        organizer = Organizer.objects.filter(
-            slug=request.resolver_match.kwargs['organizer'],
-        ).first()
+    try:
+        message, signed_message = verify_callback(webhook_json, issuer_id)
+    except CallbackVerificationError as e:
+        logger.info('Rejected Google Pay Passes callback: %s', e)
+        return HttpResponseBadRequest()
+    except RequestException:
+        # Without Google's root keys we cannot tell good from bad - let Google retry later.
+        logger.exception('Could not retrieve the Google Pay Passes root signing keys.')
+        return HttpResponse(status=503)
 
-        tasks.process_webhook.apply_async(
-            args=(request.body.decode('utf-8'), organizer.settings.googlepaypasses_issuer_id)
-        )
+    if not is_duplicate(message, signed_message):
+        tasks.process_webhook_message.apply_async(args=(message,))
 
     return HttpResponse()
+
+
+@require_GET
+def image(request, *args, **kwargs):
+    image_hash = request.resolver_match.kwargs['image_hash']
+    etag = '"%s"' % image_hash
+
+    # The URL is content-addressed, so whatever was served under it once is still valid
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
+
+    with scopes_disabled():
+        event = Event.objects.filter(
+            organizer__slug=request.resolver_match.kwargs['organizer'], slug=request.resolver_match.kwargs['event']
+        ).select_related('organizer').first()
+    if not event:
+        return HttpResponseNotFound()
+
+    name = get_image_name(event, request.resolver_match.kwargs['kind'])
+    if not name or get_image_hash(name) != image_hash:
+        return HttpResponseNotFound()
+
+    with default_storage.open(name, 'rb') as f:
+        response = HttpResponse(f.read(), content_type='image/png')
+
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response['ETag'] = etag
+    return response
+
+
+class OrderSaveLinks(TemplateView):
+    # Landing page for orders whose passes do not fit into a single save link
+    template_name = 'pretix_googlepaypasses/order.html'
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+
+        order = Order.objects.filter(event=self.request.event, code=self.kwargs['order']).first()
+        if not order or not constant_time_compare(order.secret.lower(), self.kwargs['secret'].lower()):
+            raise Http404()
+        if not order.ticket_download_available:
+            raise Http404()
+
+        jwts = WalletobjectOutput(self.request.event).get_order_jwts(order) or []
+
+        ctx['order'] = order
+        ctx['save_urls'] = [SAVE_URL % jwt for jwt in jwts]
+        return ctx
@@ -32,7 +32,7 @@ setup(
     author_email='martin@pc-coholic.de',
 
     install_requires=['google-auth'],
-    packages=find_packages(exclude=['tests', 'tests.*']),
+    packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     cmdclass=cmdclass,
     entry_points="""
@@ -0,0 +1,35 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def event():
+    with scopes_disabled():
+        organizer = Organizer.objects.create(name='Dummy', slug='dummy')
+        return Event.objects.create(organizer=organizer, name='Dummy', slug='dummy', date_from=now())
+
+
+@pytest.fixture
+def order(event):
+    with scopes_disabled():
+        item = Item.objects.create(event=event, name='Ticket', default_price=Decimal('23.00'), admission=True)
+        order = Order.objects.create(
+            code='FOO', event=event, email='dummy@dummy.test', status=Order.STATUS_PAID, datetime=now(),
+            expires=now() + timedelta(days=10), total=Decimal('46.00'),
+        )
+        OrderPosition.all.create(order=order, item=item, price=Decimal('23.00'), positionid=1)
+        OrderPosition.all.create(order=order, item=item, price=Decimal('23.00'), positionid=2, canceled=True)
+        return order
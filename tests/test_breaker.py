@@ -0,0 +1,108 @@
+import pytest
+from django.core.cache import cache
+from pretix_googlepaypasses import breaker, comms
+from pretix_googlepaypasses.breaker import (
+    STATE_CLOSED, STATE_HALF_OPEN, CircuitOpenError, after_call, before_call,
+    get_retry_in,
+)
+from pretix_googlepaypasses.comms import WalletClient
+from pretix_googlepaypasses.ratelimit import RetryableError, background_lane
+
+ISSUER = '3388000000000000000'
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000)
+    monkeypatch.setattr(breaker, 'time', clock)
+    monkeypatch.setattr(breaker, 'get_failure_threshold', lambda: 3)
+    monkeypatch.setattr(breaker, 'get_open_duration', lambda: 30)
+    return clock
+
+
+def _fail(times: int):
+    for i in range(times):
+        after_call(ISSUER, before_call(ISSUER), False)
+
+
+def _trip(clock):
+    _fail(3)
+    clock.now += 31
+
+
+def test_closed(clock):
+    assert before_call(ISSUER) == (STATE_CLOSED, False)
+    _fail(2)
+    assert before_call(ISSUER) == (STATE_CLOSED, True)
+
+
+def test_success_resets_failures(clock):
+    _fail(2)
+    after_call(ISSUER, before_call(ISSUER), True)
+    _fail(2)
+    assert before_call(ISSUER) == (STATE_CLOSED, True)
+
+
+def test_opens(clock):
+    _fail(3)
+    assert get_retry_in(ISSUER) == 31
+    with pytest.raises(CircuitOpenError):
+        before_call(ISSUER)
+    with background_lane():
+        with pytest.raises(CircuitOpenError):
+            before_call(ISSUER)
+
+
+def test_only_one_background_probe(clock):
+    _trip(clock)
+    with pytest.raises(CircuitOpenError):
+        before_call(ISSUER)
+
+    with background_lane():
+        assert before_call(ISSUER)[0] == STATE_HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            before_call(ISSUER)
+
+
+def test_probe_success_closes(clock):
+    _trip(clock)
+    with background_lane():
+        after_call(ISSUER, before_call(ISSUER), True)
+    assert before_call(ISSUER) == (STATE_CLOSED, False)
+
+
+def test_probe_failure_reopens(clock):
+    _trip(clock)
+    with background_lane():
+        after_call(ISSUER, before_call(ISSUER), False)
+        assert get_retry_in(ISSUER) == 31
+        with pytest.raises(CircuitOpenError):
+            before_call(ISSUER)
+
+    clock.now += 31
+    with background_lane():
+        assert before_call(ISSUER)[0] == STATE_HALF_OPEN
+
+
+def test_rate_limit_does_not_claim_probe(clock, monkeypatch):
+    def exhausted(bucket, tokens=1):
+        raise RetryableError('Rate limit for %s exhausted' % bucket)
+
+    monkeypatch.setattr(comms, 'acquire', exhausted)
+    client = WalletClient.__new__(WalletClient)
+    client.bucket = 'bucket'
+    _trip(clock)
+
+    with background_lane():
+        with pytest.raises(RetryableError):
+            client._request('GET', 'eventTicketObject/%s.object' % ISSUER, 'get', ISSUER)
+        assert before_call(ISSUER)[0] == STATE_HALF_OPEN
+    assert cache.get(breaker._key(ISSUER, 'opened')) is not None
@@ -0,0 +1,103 @@
+import base64
+import json
+import time
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from pretix_googlepaypasses import callbacks
+from pretix_googlepaypasses.callbacks import (
+    PROTOCOL_VERSION, SENDER_ID, CallbackVerificationError, _length_prefixed,
+    verify_callback,
+)
+
+ISSUER_ID = '3388000000000000000'
+
+
+def _public_key(key):
+    return base64.b64encode(key.public_key().public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )).decode('utf-8')
+
+
+def _sign(key, data: bytes):
+    return base64.b64encode(key.sign(data, ec.ECDSA(hashes.SHA256()))).decode('utf-8')
+
+
+def _expiration(seconds: int):
+    return int((time.time() + seconds) * 1000)
+
+
+@pytest.fixture
+def root_key(monkeypatch):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    monkeypatch.setitem(callbacks._root_keys, 'keys', [{'keyValue': _public_key(key), 'protocolVersion': PROTOCOL_VERSION}])
+    monkeypatch.setitem(callbacks._root_keys, 'expires', time.time() + 3600)
+    return key
+
+
+def _callback(root_key, issuer_id=ISSUER_ID, key_expiration=3600, message_expiration=3600):
+    intermediate_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    signed_key = json.dumps({
+        'keyValue': _public_key(intermediate_key),
+        'keyExpiration': str(_expiration(key_expiration)),
+    })
+    signed_message = json.dumps({
+        'classId': '%s.class' % ISSUER_ID,
+        'objectId': '%s.object' % ISSUER_ID,
+        'eventType': 'del',
+        'expTimeMillis': _expiration(message_expiration),
+        'nonce': 'abc',
+    })
+    return {
+        'protocolVersion': PROTOCOL_VERSION,
+        'intermediateSigningKey': {
+            'signedKey': signed_key,
+            'signatures': [_sign(root_key, _length_prefixed(SENDER_ID, PROTOCOL_VERSION, signed_key))],
+        },
+        'signedMessage': signed_message,
+        'signature': _sign(intermediate_key, _length_prefixed(SENDER_ID, issuer_id, PROTOCOL_VERSION, signed_message)),
+    }
+
+
+def test_valid_callback(root_key):
+    callback = _callback(root_key)
+    message, signed_message = verify_callback(callback, ISSUER_ID)
+    assert message['objectId'] == '%s.object' % ISSUER_ID
+    assert signed_message == callback['signedMessage']
+
+
+def test_other_issuer(root_key):
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(_callback(root_key, issuer_id='3388000000000000001'), ISSUER_ID)
+
+
+def test_tampered_message(root_key):
+    callback = _callback(root_key)
+    callback['signedMessage'] = callback['signedMessage'].replace('del', 'save')
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(callback, ISSUER_ID)
+
+
+def test_unknown_root_key(root_key):
+    callback = _callback(ec.generate_private_key(ec.SECP256R1(), default_backend()))
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(callback, ISSUER_ID)
+
+
+def test_expired_intermediate_key(root_key):
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(_callback(root_key, key_expiration=-60), ISSUER_ID)
+
+
+def test_expired_message(root_key):
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(_callback(root_key, message_expiration=-60), ISSUER_ID)
+
+
+def test_malformed_callback(root_key):
+    with pytest.raises(CallbackVerificationError):
+        verify_callback({'protocolVersion': PROTOCOL_VERSION}, ISSUER_ID)
+    with pytest.raises(CallbackVerificationError):
+        verify_callback(dict(_callback(root_key), protocolVersion='ECv1'), ISSUER_ID)
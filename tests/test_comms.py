@@ -0,0 +1,45 @@
+from pretix_googlepaypasses.comms import _parse_batch_response
+
+
+class Response:
+    def __init__(self, text: str, content_type: str = 'multipart/mixed; boundary=batch_abc'):
+        self.headers = {'Content-Type': content_type}
+        self.text = text
+
+
+def _part(content_id: str, status: str):
+    return (
+        'Content-Type: application/http\r\n'
+        'Content-ID: <%s>\r\n'
+        '\r\n'
+        'HTTP/1.1 %s\r\n'
+        'Content-Type: application/json; charset=UTF-8\r\n'
+        '\r\n'
+        '{}\r\n' % (content_id, status)
+    )
+
+
+def test_parse_batch_response():
+    response = Response(''.join([
+        '--batch_abc\r\n', _part('response-item0', '200 OK'),
+        '--batch_abc\r\n', _part('response-item1', '404 Not Found'),
+        '--batch_abc\r\n', _part('response-item2', '503 Service Unavailable'),
+        '--batch_abc--\r\n',
+    ]))
+    assert _parse_batch_response(response) == {0: 200, 1: 404, 2: 503}
+
+
+def test_parse_batch_response_quoted_boundary():
+    response = Response('--batch_abc\r\n' + _part('response-item0', '200 OK') + '--batch_abc--\r\n',
+                        'multipart/mixed; boundary="batch_abc"')
+    assert _parse_batch_response(response) == {0: 200}
+
+
+def test_parse_batch_response_missing_items():
+    # Items without a response are left out, the caller counts them as failed
+    response = Response('--batch_abc\r\n' + _part('response-item1', '200 OK') + '--batch_abc--\r\n')
+    assert _parse_batch_response(response) == {1: 200}
+
+
+def test_parse_batch_response_not_multipart():
+    assert _parse_batch_response(Response('{"error": {}}', 'application/json')) == {}
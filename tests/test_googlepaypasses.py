@@ -0,0 +1,60 @@
+import pytest
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPosition
+from pretix_googlepaypasses.googlepaypasses import WalletobjectOutput
+from pretix_googlepaypasses.models import GooglePayPass
+
+pytestmark = pytest.mark.django_db
+
+
+class Comms:
+    def __init__(self):
+        self.puts = []
+
+    def put_item(self, item_type, item_id, item):
+        self.puts.append(item_id)
+        return {'id': item_id}
+
+
+@pytest.fixture
+def output(event, monkeypatch):
+    output = WalletobjectOutput(event)
+    comms = Comms()
+    monkeypatch.setattr(output, '_comms', lambda: comms)
+    return output
+
+
+@pytest.fixture
+def googlepaypass(order, output):
+    with scopes_disabled():
+        op = OrderPosition.objects.get(order=order)
+        googlepaypass = GooglePayPass.objects.create(object_id='1.object', class_id='1.class', position=op,
+                                                     event=order.event)
+        googlepaypass.payload_hash = output._build_object(op, googlepaypass)[2]
+        googlepaypass.save()
+        return googlepaypass
+
+
+@scopes_disabled()
+def test_unchanged_object_is_not_written(output, googlepaypass):
+    ticket_object, payload_hash = output._generate_object(googlepaypass.position, googlepaypass)
+    assert ticket_object['id'] == '1.object'
+    assert payload_hash == googlepaypass.payload_hash
+    assert output._comms().puts == []
+
+
+@scopes_disabled()
+def test_forced_object_is_written(output, googlepaypass):
+    output._generate_object(googlepaypass.position, googlepaypass, force=True)
+    assert output._comms().puts == ['1.object']
+
+
+@scopes_disabled()
+def test_changed_object_is_written(output, googlepaypass):
+    op = googlepaypass.position
+    op.attendee_name_parts = {'_legacy': 'Peter'}
+    op.save()
+
+    ticket_object, payload_hash = output._generate_object(op, googlepaypass)
+    assert payload_hash != googlepaypass.payload_hash
+    assert output._comms().puts == ['1.object']
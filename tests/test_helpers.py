@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPosition
+from pretix_googlepaypasses.helpers import (
+    claim_upload, get_cached_save_url, get_passes, get_save_url_fingerprint,
+    invalidate_save_urls, set_cached_save_url,
+)
+from pretix_googlepaypasses.models import GooglePayPass
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def position(order):
+    with scopes_disabled():
+        return OrderPosition.objects.get(order=order)
+
+
+def _legacy(op, object_id, payload_hash=None):
+    meta_info = {'googlepaypass': object_id}
+    if payload_hash:
+        meta_info['googlepaypass_hash'] = payload_hash
+    op.meta_info = json.dumps(meta_info)
+    op.save(update_fields=['meta_info'])
+
+
+@scopes_disabled()
+def test_get_passes_migrates_legacy_pass(position):
+    _legacy(position, '1.legacy', 'abc')
+
+    googlepaypass = get_passes([position])[position.pk]
+    assert googlepaypass.object_id == '1.legacy'
+    assert googlepaypass.payload_hash == 'abc'
+    assert googlepaypass.state == GooglePayPass.STATE_ACTIVE
+
+    assert get_passes([position])[position.pk].pk == googlepaypass.pk
+    assert GooglePayPass.objects.count() == 1
+
+
+@scopes_disabled()
+def test_get_passes_prefers_table(position):
+    _legacy(position, '1.legacy')
+    GooglePayPass.objects.create(object_id='1.current', class_id='1.class', position=position, event=position.order.event)
+
+    assert get_passes([position])[position.pk].object_id == '1.current'
+    assert not GooglePayPass.objects.filter(object_id='1.legacy').exists()
+
+
+@scopes_disabled()
+def test_get_passes_skips_deactivated_legacy_pass(position):
+    _legacy(position, '1.legacy')
+    GooglePayPass.objects.create(object_id='1.legacy', class_id='1.class', position=position,
+                                 event=position.order.event, state=GooglePayPass.STATE_INACTIVE)
+
+    assert get_passes([position]) == {}
+    assert GooglePayPass.objects.count() == 1
+
+
+@scopes_disabled()
+def test_get_passes_without_pass(position):
+    assert get_passes([position]) == {}
+    assert not GooglePayPass.objects.exists()
+
+
+def test_save_url_fingerprint():
+    fingerprint = get_save_url_fingerprint('hash', 'key', 'https://pretix.eu')
+    assert fingerprint == get_save_url_fingerprint('hash', 'key', 'https://pretix.eu')
+    assert fingerprint != get_save_url_fingerprint('other', 'key', 'https://pretix.eu')
+    assert fingerprint != get_save_url_fingerprint('hash', 'rotated', 'https://pretix.eu')
+    assert fingerprint != get_save_url_fingerprint('hash', 'key', 'https://pretix.eu', 'class')
+
+
+def test_cached_save_url():
+    fingerprint = get_save_url_fingerprint('hash', 'key', 'https://pretix.eu')
+    set_cached_save_url('1.object', fingerprint, 'https://pay.google.com/gp/v/save/jwt')
+
+    assert get_cached_save_url('1.object', fingerprint) == 'https://pay.google.com/gp/v/save/jwt'
+    assert get_cached_save_url('1.object', get_save_url_fingerprint('changed', 'key', 'https://pretix.eu')) is None
+    assert get_cached_save_url('1.other', fingerprint) is None
+
+    invalidate_save_urls(['1.object'])
+    assert get_cached_save_url('1.object', fingerprint) is None
+
+
+def test_claim_upload():
+    assert claim_upload('1.object', 'abc')
+    assert not claim_upload('1.object', 'abc')
+    # A payload that changed again needs an upload of its own
+    assert claim_upload('1.object', 'def')
@@ -0,0 +1,176 @@
+from collections import Counter
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+from pretix_googlepaypasses import outbox, tasks
+from pretix_googlepaypasses.models import OutboxEntry
+from pretix_googlepaypasses.outbox import (
+    BACKOFF_BASE, BACKOFF_MAX, LEASE, MAX_ATTEMPTS, _claim, _process, drain,
+    enqueue, kick, retry_failed,
+)
+from pretix_googlepaypasses.ratelimit import RetryableError
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    calls = []
+
+    def handle(target_ids):
+        calls.append(target_ids)
+        if isinstance(handle.result, Exception):
+            raise handle.result
+        return handle.result
+
+    handle.calls = calls
+    handle.result = set()
+    monkeypatch.setitem(tasks.OUTBOX_HANDLERS, OutboxEntry.OP_SHRED_OBJECT, handle)
+    return handle
+
+
+def test_enqueue_coalesces(event):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 2, event.pk)
+
+    entry = OutboxEntry.objects.get(key='shred_object:1')
+    assert entry.version == 2
+    assert OutboxEntry.objects.count() == 2
+
+
+def test_enqueue_records_coalescing(event, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(outbox, 'record_debounce', lambda task, result: recorded.append((task, result)))
+    enqueue(OutboxEntry.OP_REFRESH_ORDER, 1, event.pk)
+    enqueue(OutboxEntry.OP_REFRESH_ORDER, 1, event.pk)
+    assert recorded == [('refresh_order', 'triggered'), ('refresh_order', 'triggered'), ('refresh_order', 'coalesced')]
+
+
+def test_shred_order_drops_refresh(event):
+    enqueue(OutboxEntry.OP_REFRESH_ORDER, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_ORDER, 1, event.pk)
+    assert list(OutboxEntry.objects.values_list('operation', flat=True)) == [OutboxEntry.OP_SHRED_ORDER]
+
+
+def test_claim_leases_due_entries(event):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 2, event.pk, delay=60)
+
+    entries = _claim(100)
+    assert [entry.target_id for entry in entries] == [1]
+    assert OutboxEntry.objects.get(target_id=1).next_attempt > now() + LEASE - timedelta(seconds=10)
+    assert _claim(100) == []
+
+
+def test_process_deletes_done(event, handler):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 2, event.pk)
+    handler.result = {1, 2}
+
+    stats = Counter()
+    _process(_claim(100), stats)
+    assert sorted(handler.calls[0]) == [1, 2]
+    assert stats['shred_object_done'] == 2
+    assert not OutboxEntry.objects.exists()
+
+
+def test_process_keeps_retriggered(event, handler):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    entries = _claim(100)
+
+    # Triggered again while being processed
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    handler.result = {1}
+    _process(entries, Counter())
+
+    entry = OutboxEntry.objects.get()
+    assert entry.version == 2
+    assert entry.attempts == 0
+    assert entry.next_attempt <= now()
+
+
+def test_failure_backs_off(event, handler):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    handler.result = RetryableError('HTTP 503')
+
+    _process(_claim(100), Counter())
+    entry = OutboxEntry.objects.get()
+    assert entry.attempts == 1
+    assert entry.state == OutboxEntry.STATE_PENDING
+    assert entry.last_error == 'HTTP 503'
+    assert now() + timedelta(seconds=BACKOFF_BASE / 2 - 5) < entry.next_attempt
+    assert entry.next_attempt < now() + timedelta(seconds=BACKOFF_BASE + 5)
+
+    OutboxEntry.objects.update(attempts=3, next_attempt=now())
+    _process(_claim(100), Counter())
+    entry = OutboxEntry.objects.get()
+    assert entry.attempts == 4
+    assert now() + timedelta(seconds=BACKOFF_BASE * 4 - 5) < entry.next_attempt
+    assert entry.next_attempt < now() + timedelta(seconds=BACKOFF_BASE * 8 + 5)
+
+
+def test_unfinished_targets_fail(event, handler):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 2, event.pk)
+    handler.result = {2}
+
+    _process(_claim(100), Counter())
+    entry = OutboxEntry.objects.get()
+    assert entry.target_id == 1
+    assert entry.attempts == 1
+
+
+def test_gives_up(event, handler):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    OutboxEntry.objects.update(attempts=MAX_ATTEMPTS - 1)
+
+    _process(_claim(100), Counter())
+    entry = OutboxEntry.objects.get()
+    assert entry.state == OutboxEntry.STATE_FAILED
+    assert _claim(100) == []
+
+    assert retry_failed() == 1
+    entry = OutboxEntry.objects.get()
+    assert entry.state == OutboxEntry.STATE_PENDING
+    assert entry.attempts == 0
+
+
+def test_drain_schedules_next_attempt(event, handler, monkeypatch):
+    kicks = []
+    monkeypatch.setattr(outbox, 'kick', lambda countdown=0: kicks.append(countdown))
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk, delay=120)
+
+    drain()
+    assert handler.calls == []
+    assert len(kicks) == 1
+    assert 110 < kicks[0] <= 121
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    countdowns = []
+    monkeypatch.setattr(tasks.drain_outbox, 'apply_async', lambda countdown=0: countdowns.append(countdown))
+    return countdowns
+
+
+def test_kick_dedupes(scheduled):
+    kick()
+    kick()
+    kick(60)
+    assert scheduled == [0]
+
+
+def test_kick_not_held_up_by_backoff(event, handler, scheduled):
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 1, event.pk)
+    OutboxEntry.objects.update(attempts=10, next_attempt=now() + timedelta(seconds=BACKOFF_MAX))
+
+    drain()
+    assert len(scheduled) == 1
+    assert BACKOFF_MAX - 10 < scheduled[0] <= BACKOFF_MAX + 1
+
+    # A new entry must not wait for the backed off one
+    enqueue(OutboxEntry.OP_SHRED_OBJECT, 2, event.pk)
+    kick()
+    assert scheduled[1:] == [0]
@@ -0,0 +1,78 @@
+import pytest
+from django.core.cache import cache
+from pretix_googlepaypasses import ratelimit
+from pretix_googlepaypasses.ratelimit import (
+    RetryableError, acquire, background_lane,
+)
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000.5)
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    monkeypatch.setattr(ratelimit, 'get_requests_per_second', lambda: 20)
+    return clock
+
+
+def _used(second: int):
+    return cache.get('googlepaypasses_ratelimit_bucket_%d' % second)
+
+
+def test_interactive_budget(clock):
+    assert acquire('bucket', 20)
+    assert clock.now == 1000.5
+    assert acquire('bucket')
+    assert clock.now == 1001
+    assert _used(1000) == 20
+    assert _used(1001) == 1
+
+
+def test_background_keeps_reserve(clock):
+    with background_lane():
+        assert acquire('bucket', 15)
+
+    # The part reserved for interactive calls is still there
+    assert acquire('bucket', 5)
+    assert clock.now == 1000.5
+
+    with background_lane():
+        assert acquire('bucket')
+    assert clock.now == 1001
+    assert _used(1000) == 20
+    assert _used(1001) == 1
+
+
+def test_refused_tokens_are_returned(clock):
+    assert acquire('bucket', 18)
+    assert acquire('bucket', 5)
+    assert _used(1000) == 18
+    assert _used(1001) == 5
+
+
+def test_large_request_spread_over_windows(clock):
+    with background_lane():
+        assert acquire('bucket', 50)
+    assert [_used(second) for second in range(1000, 1004)] == [15, 15, 15, 5]
+
+
+def test_exhausted(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'INTERACTIVE_MAX_WAIT', 0)
+    monkeypatch.setattr(ratelimit, 'BACKGROUND_MAX_WAIT', 0)
+    assert acquire('bucket', 20)
+
+    assert not acquire('bucket')
+    with background_lane():
+        with pytest.raises(RetryableError):
+            acquire('bucket')
+    assert _used(1000) == 20
@@ -0,0 +1,94 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from pretix_googlepaypasses import signals
+from pretix_googlepaypasses.debounce import DEFAULT_WINDOW
+from pretix_googlepaypasses.models import OutboxEntry
+from pretix_googlepaypasses.signals import logentry_post_save
+
+
+class Event:
+    def __init__(self, pk: int, plugins: str):
+        self.pk = pk
+        self.plugins = plugins
+        self.plugin_lookups = 0
+
+    def get_plugins(self):
+        self.plugin_lookups += 1
+        return self.plugins.split(',')
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    calls = []
+    monkeypatch.setattr(signals.transaction, 'on_commit', lambda func: func())
+    monkeypatch.setattr(signals, 'enqueue', lambda *args, **kwargs: calls.append(('enqueue', args, kwargs)))
+    monkeypatch.setattr(signals, 'debounce', lambda *args: calls.append(('debounce', args, {})))
+    monkeypatch.setattr(signals, '_invalidate_event', lambda event: calls.append(('invalidate', (event.pk,), {})))
+    return calls
+
+
+@pytest.fixture
+def event():
+    return Event(1, 'pretix.plugins.banktransfer,pretix_googlepaypasses')
+
+
+def _log(action_type: str, event, object_id=10, data=None):
+    logentry = SimpleNamespace(action_type=action_type, event=event, event_id=event.pk if event else None,
+                               object_id=object_id, data=json.dumps(data) if data is not None else None)
+    logentry_post_save(sender=None, instance=logentry)
+
+
+def test_other_actions_are_dropped(dispatched, event):
+    _log('pretix.event.order.paid', event)
+    _log('pretix.event.order.changed.cancel', None)
+    assert dispatched == []
+    assert event.plugin_lookups == 0
+
+
+def test_plugin_disabled(dispatched):
+    event = Event(2, 'pretix.plugins.banktransfer')
+    _log('pretix.event.order.changed.cancel', event)
+    _log('pretix.event.changed', event)
+    assert dispatched == []
+
+
+def test_plugin_check_is_cached(dispatched, event):
+    _log('pretix.event.order.changed.cancel', event)
+    _log('pretix.event.order.changed.price', event)
+    assert event.plugin_lookups == 1
+
+    _log('pretix.event.plugins.disabled', event)
+    event.plugins = ''
+    _log('pretix.event.order.changed.price', event)
+    assert event.plugin_lookups == 2
+    assert len(dispatched) == 2
+
+
+def test_shred_position(dispatched, event):
+    _log('pretix.event.order.changed.cancel', event, data={'position': 4, 'positionid': 1})
+    assert dispatched == [('enqueue', (OutboxEntry.OP_SHRED_OBJECT, 4, 1), {})]
+
+
+def test_shred_order(dispatched, event):
+    _log('pretix.event.order.secret.changed', event, data={})
+    assert dispatched == [('enqueue', (OutboxEntry.OP_SHRED_ORDER, 10, 1), {})]
+
+
+def test_refresh_order(dispatched, event):
+    _log('pretix.event.order.changed.item', event, data={'position': 4, 'positionid': 1})
+    assert dispatched == [('enqueue', (OutboxEntry.OP_REFRESH_ORDER, 10, 1), {'delay': DEFAULT_WINDOW})]
+
+
+def test_event_changed(dispatched, event):
+    _log('pretix.event.settings', event)
+    assert dispatched == [
+        ('invalidate', (1,), {}),
+        ('enqueue', (OutboxEntry.OP_REFRESH_CLASS, 1, 1), {'delay': DEFAULT_WINDOW}),
+    ]
+
+
+def test_organizer_changed(dispatched):
+    _log('pretix.organizer.settings', None, object_id=3)
+    assert dispatched == [('debounce', ('refresh_organizer_classes', 3), {})]
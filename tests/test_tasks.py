@@ -0,0 +1,32 @@
+import pytest
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPosition
+from pretix_googlepaypasses.models import GooglePayPass
+from pretix_googlepaypasses.tasks import _shredded
+
+pytestmark = pytest.mark.django_db
+
+
+def _pass(op, object_id, state=GooglePayPass.STATE_ACTIVE):
+    return GooglePayPass.objects.create(object_id=object_id, class_id='1.class', position=op, event=op.order.event,
+                                        state=state)
+
+
+@scopes_disabled()
+def test_shredded_includes_canceled_positions(order):
+    active, canceled = OrderPosition.all.filter(order=order).order_by('positionid')
+    _pass(active, '1.active', GooglePayPass.STATE_INACTIVE)
+    _pass(canceled, '1.canceled', GooglePayPass.STATE_INACTIVE)
+    assert _shredded([active.pk, canceled.pk]) == {active.pk, canceled.pk}
+
+
+@scopes_disabled()
+def test_shredded_needs_inactive_pass(order):
+    canceled = OrderPosition.all.get(order=order, canceled=True)
+    _pass(canceled, '1.canceled')
+    assert _shredded([canceled.pk]) == set()
+
+
+@scopes_disabled()
+def test_shredded_needs_position(order):
+    assert _shredded([OrderPosition.all.order_by('-pk').first().pk + 1]) == set()